@@ -0,0 +1,179 @@
+import json
+import logging
+from settings import print_log
+
+
+class FileSink:
+    """
+    Appends the alerts to a file, one json object per line
+    """
+    def __init__(self, path):
+        """
+        :param path - File path
+        """
+        self.path = path
+
+    def send(self, alerts):
+        with open(self.path, 'a') as f:
+            for alert in alerts:
+                f.write(json.dumps(alert) + "\n")
+
+
+class WebhookSink:
+    """
+    Posts the alerts in json to a URL
+    """
+    def __init__(self, url, timeout_sec=10):
+        """
+        :param url - Webhook URL
+        :param timeout_sec - Timeout of the request in seconds
+        """
+        self.url = url
+        self.timeout_sec = timeout_sec
+
+    def send(self, alerts):
+        import requests
+        requests.post(self.url, json={'alerts': alerts}, timeout=self.timeout_sec).raise_for_status()
+
+
+class SmtpSink:
+    """
+    Emails the alerts through an SMTP server, e.g. the local one
+    """
+    def __init__(self, host, port, sender, recipients):
+        """
+        :param host - SMTP server host
+        :param port - SMTP server port
+        :param sender - Sender address
+        :param recipients - List of recipient addresses
+        """
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+
+    def send(self, alerts):
+        import smtplib
+        from email.message import EmailMessage
+        msg = EmailMessage()
+        msg['Subject'] = "%d flight price alerts" % len(alerts)
+        msg['From'] = self.sender
+        msg['To'] = ", ".join(self.recipients)
+        msg.set_content("\n".join(PriceAlerts.format(a) for a in alerts))
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            smtp.send_message(msg)
+
+
+class PriceAlerts:
+    """
+    Detects the price drops of a batch of observations against the last and
+    the lowest price seen of each route and date pair, i.e. the
+    price_calendar rows, so the cost is in the number of new observations
+    only. An alert is raised when the price drops by at least the threshold
+    from the last price seen, or goes below the lowest price ever seen.
+    """
+    DROP = 'drop'
+    NEW_LOW = 'new_low'
+
+    def __init__(self, sinks, drop_pct=10.0):
+        """
+        :param sinks - List of the sinks, each with a send(alerts) method
+        :param drop_pct - Minimum drop from the last price seen in percent
+        """
+        self.sinks = sinks
+        self.drop_pct = drop_pct
+
+    def detect(self, previous, current):
+        """
+        :param previous - Dictionary of (route, outbound date, inbound date)
+                          to the (last price, lowest price) seen before the
+                          batch
+        :param current - Dictionary of the same key to the price_calendar
+                         row of the batch, i.e. (route, origin, destination,
+                         outbound date, inbound date, observed at, last
+                         price, lowest price, count)
+        :return List of the alerts
+        """
+        alerts = []
+        for key, row in current.items():
+            seen = previous.get(key)
+            if seen is None:
+                continue
+
+            last_price, min_price = seen
+            price = row[6]
+            if row[7] < min_price:
+                kind = PriceAlerts.NEW_LOW
+                price = row[7]
+            elif last_price > 0 and (last_price - price) / last_price * 100 >= self.drop_pct:
+                kind = PriceAlerts.DROP
+            else:
+                continue
+
+            alerts.append({'type': kind,
+                           'route': row[0],
+                           'origin': row[1],
+                           'destination': row[2],
+                           'outbound_date': row[3],
+                           'inbound_date': row[4],
+                           'observed_at': row[5],
+                           'price': price,
+                           'last_price': last_price,
+                           'min_price': min_price})
+        return alerts
+
+    @staticmethod
+    def format(alert):
+        """
+        :return Readable alert
+        """
+        return "%s %s %s/%s: %.2f (last %.2f, lowest %.2f)" % (
+            "New low" if alert['type'] == PriceAlerts.NEW_LOW else "Drop",
+            alert['route'], alert['outbound_date'], alert['inbound_date'],
+            alert['price'], alert['last_price'], alert['min_price'])
+
+    def send(self, alerts):
+        """
+        Send the alerts to all the sinks. A failing sink is logged and does
+        not stop the others.
+        """
+        if len(alerts) == 0:
+            return
+
+        for alert in alerts:
+            print_log(self.__class__.__name__, self.send.__name__, "%s", self.format(alert))
+
+        for sink in self.sinks:
+            try:
+                sink.send(alerts)
+            except Exception as ex:
+                print_log(self.__class__.__name__,
+                          self.send.__name__,
+                          "%s failed: %s", sink.__class__.__name__, ex,
+                          level=logging.WARNING)
+
+
+def create_alerts(conf):
+    """
+    Create the price alerts from the configuration
+    :param conf - Configuration object
+    :return PriceAlerts, or None if no sink is configured
+    """
+    sinks = []
+    for sink in conf.get_alert_sinks():
+        kind, _, target = sink.partition(':')
+        if kind == 'file':
+            sinks.append(FileSink(target))
+        elif kind == 'webhook':
+            sinks.append(WebhookSink(target))
+        elif kind == 'smtp':
+            host, _, port = target.partition(':')
+            sinks.append(SmtpSink(host or 'localhost', int(port or 25),
+                                  conf.get_alert_email_from(), conf.get_alert_email_to()))
+        else:
+            raise ValueError("Unknown alert sink %s" % sink)
+
+    if len(sinks) == 0:
+        return None
+
+    return PriceAlerts(sinks, drop_pct=conf.get_alert_drop_pct())
@@ -0,0 +1,195 @@
+import threading
+import warnings
+from datetime import datetime
+import numpy as np
+from db import connect_sqlite
+
+
+class PriceAnalytics:
+    """
+    Price calendar, heatmap and trend views over the price history. The
+    views read the aggregate tables maintained by SqliteClient, one row per
+    route and date pair or per route and day, and compute on numpy arrays.
+    """
+    def __init__(self, sqlite_file_path):
+        """
+        :param sqlite_file_path - Sqlite file path of the price history
+        """
+        self.conn = connect_sqlite(sqlite_file_path)
+        self.lock = threading.Lock()
+
+    def has_history(self):
+        """
+        :return True if the aggregate tables exist, i.e. the monitor has run
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) FROM sqlite_master "
+                                    "WHERE type = 'table' AND name = 'price_calendar'").fetchone()
+        return row[0] > 0
+
+    def load_calendar(self, origin, destinations, start_date, end_date):
+        """
+        :param origin - Origin place ID
+        :param destinations - List of destination place IDs, all if empty
+        :param start_date - First outbound date in %Y-%m-%d
+        :param end_date - Last outbound date in %Y-%m-%d
+        :return Dictionary of the arrays destination, outbound (datetime64[D]),
+                duration in days, price (latest) and min_price
+        """
+        sql = "SELECT destination, outbound_date, inbound_date, price, min_price FROM price_calendar " \
+              "WHERE origin = ? AND outbound_date BETWEEN ? AND ?"
+        params = [origin, start_date, end_date]
+        if len(destinations) > 0:
+            sql += " AND destination IN (%s)" % ", ".join("?" * len(destinations))
+            params += destinations
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        if len(rows) == 0:
+            return None
+
+        destination, outbound, inbound, price, min_price = zip(*rows)
+        outbound = np.array(outbound, dtype='datetime64[D]')
+        return {'destination': np.array(destination),
+                'outbound': outbound,
+                'duration': (np.array(inbound, dtype='datetime64[D]') - outbound).astype(int),
+                'price': np.array(price, dtype=float),
+                'min_price': np.array(min_price, dtype=float)}
+
+    @staticmethod
+    def reduce(cube, percentile=None):
+        """
+        Reduce the first axis of the array, ignoring the missing prices
+        :param percentile - Percentile between 0 and 100, the minimum if None
+        """
+        with warnings.catch_warnings():
+            # All-nan slices, i.e. cells without any price, stay nan
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if percentile is None:
+                return np.nanmin(cube, axis=0)
+            return np.nanpercentile(cube, percentile, axis=0)
+
+    @staticmethod
+    def to_list(values):
+        """
+        :return List of the rounded values, None for the missing ones
+        """
+        return [None if np.isnan(v) else round(float(v), 2) for v in values]
+
+    def heatmap(self, origin, destinations, start_date, end_date, percentile=None):
+        """
+        Departure date x trip duration grid of the latest prices, combined
+        over the destinations
+        :param origin - Origin place ID
+        :param destinations - List of destination place IDs, all if empty
+        :param start_date - First outbound date in %Y-%m-%d
+        :param end_date - Last outbound date in %Y-%m-%d
+        :param percentile - Percentile over the destinations, the lowest if None
+        :return Dictionary of the dates, durations and the price grid, None
+                if there is no price
+        """
+        cal = self.load_calendar(origin, destinations, start_date, end_date)
+        if cal is None:
+            return None
+
+        dates = np.arange(np.datetime64(start_date), np.datetime64(end_date) + 1)
+        durations, duration_idx = np.unique(cal['duration'], return_inverse=True)
+        _, destination_idx = np.unique(cal['destination'], return_inverse=True)
+        cube = np.full((destination_idx.max() + 1, len(dates), len(durations)), np.nan)
+        cube[destination_idx, (cal['outbound'] - dates[0]).astype(int), duration_idx] = cal['price']
+        grid = self.reduce(cube, percentile)
+
+        return {'dates': [str(d) for d in dates],
+                'durations': [int(d) for d in durations],
+                'prices': [self.to_list(row) for row in grid],
+                'min_price': round(float(np.nanmin(grid)), 2),
+                'max_price': round(float(np.nanmax(grid)), 2)}
+
+    def cheapest_weeks(self, origin, destinations, start_date, end_date):
+        """
+        Rank the weeks, starting on Monday, by the lowest latest price of the
+        outbound dates in the week
+        :return List of dictionaries of the week, its cheapest outbound date,
+                lowest price and median of the daily lowest prices, sorted by
+                the lowest price
+        """
+        cal = self.load_calendar(origin, destinations, start_date, end_date)
+        if cal is None:
+            return []
+
+        # 1970-01-01 was a Thursday, so the Monday of the first week is 3 days before
+        first = np.datetime64(start_date)
+        first -= (first.astype(int) + 3) % 7
+        n_weeks = int((np.datetime64(end_date) - first).astype(int)) // 7 + 1
+        daily = np.full(n_weeks * 7, np.nan)
+        np.fmin.at(daily, (cal['outbound'] - first).astype(int), cal['price'])
+        daily = daily.reshape(n_weeks, 7)
+
+        lowest = self.reduce(daily.T)
+        median = self.reduce(daily.T, 50)
+        cheapest_day = np.argmin(np.where(np.isnan(daily), np.inf, daily), axis=1)
+        weeks = [{'week': str(first + 7 * n),
+                  'cheapest_date': str(first + 7 * n + int(cheapest_day[n])),
+                  'min_price': round(float(lowest[n]), 2),
+                  'median_price': round(float(median[n]), 2)}
+                 for n in np.argsort(lowest, kind='stable') if not np.isnan(lowest[n])]
+        return weeks
+
+    def trend(self, origin, destinations, days=30, today=None):
+        """
+        Daily lowest price of each route over the last days, and its linear
+        trend
+        :param origin - Origin place ID
+        :param destinations - List of destination place IDs, all if empty
+        :param days - Number of days
+        :param today - Last day in %Y-%m-%d, today if None
+        :return List of dictionaries of the route, the days, the daily lowest
+                and average prices, the slope per day and the change in percent,
+                None if the first lowest price is 0
+        """
+        end = np.datetime64(today or datetime.utcnow().strftime("%Y-%m-%d"))
+        start = end - (days - 1)
+        sql = "SELECT route, day, min_price, sum_price, n FROM price_trend " \
+              "WHERE origin = ? AND day BETWEEN ? AND ?"
+        params = [origin, str(start), str(end)]
+        if len(destinations) > 0:
+            sql += " AND destination IN (%s)" % ", ".join("?" * len(destinations))
+            params += destinations
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        if len(rows) == 0:
+            return []
+
+        route, day, min_price, sum_price, n = zip(*rows)
+        routes, route_idx = np.unique(np.array(route), return_inverse=True)
+        day_idx = (np.array(day, dtype='datetime64[D]') - start).astype(int)
+        lowest = np.full((len(routes), days), np.nan)
+        average = np.full((len(routes), days), np.nan)
+        lowest[route_idx, day_idx] = min_price
+        average[route_idx, day_idx] = np.array(sum_price) / np.array(n)
+
+        # Least squares slope of each route over its observed days
+        observed = ~np.isnan(lowest)
+        x = np.where(observed, np.arange(days), 0.0)
+        count = observed.sum(axis=1)
+        x_mean = x.sum(axis=1) / count
+        y_mean = np.where(observed, lowest, 0.0).sum(axis=1) / count
+        dx = np.where(observed, x - x_mean[:, None], 0.0)
+        dy = np.where(observed, lowest - y_mean[:, None], 0.0)
+        var = (dx * dx).sum(axis=1)
+        slope = np.divide((dx * dy).sum(axis=1), var, out=np.zeros(len(routes)), where=var > 0)
+
+        first = lowest[np.arange(len(routes)), observed.argmax(axis=1)]
+        last = lowest[np.arange(len(routes)), days - 1 - observed[:, ::-1].argmax(axis=1)]
+        dates = [str(start + d) for d in range(days)]
+        return [{'route': str(routes[r]),
+                 'days': dates,
+                 'min_prices': self.to_list(lowest[r]),
+                 'average_prices': self.to_list(average[r]),
+                 'slope_per_day': round(float(slope[r]), 2),
+                 'change_pct': None if first[r] == 0 else
+                 round(float((last[r] - first[r]) / first[r] * 100), 2)}
+                for r in range(len(routes))]
@@ -0,0 +1,202 @@
+import argparse
+import gc
+import glob
+import json
+import sys
+import time
+import tracemalloc
+from functools import partial
+from filters import ItineraryFilter
+from synthetic import generate_response
+
+
+def percentile(samples, q):
+    """
+    :param samples - Sorted list of samples
+    :param q - Percentile between 0 and 100
+    :return The nearest-rank percentile
+    """
+    return samples[min(len(samples) - 1, int(round(q / 100.0 * (len(samples) - 1))))]
+
+
+def load_recorded(record_dir):
+    """
+    Load the live pricing responses recorded by RecordTransport
+    :param record_dir - Directory of the recorded responses
+    :return List of the responses in json
+    """
+    contents = []
+    for path in sorted(glob.glob("%s/*.json" % record_dir)):
+        with open(path) as f:
+            content = json.load(f)['content']
+        if '"Itineraries"' in content:
+            contents.append(content)
+    return contents
+
+
+def build_stages(filter):
+    """
+    The benchmarked stages. Each stage takes the responses of a search in
+    json and returns the number of itineraries processed.
+    :param filter - ItineraryFilter
+    :return List of (stage name, setup, run). setup prepares the input of
+            run from the responses outside of the timing.
+    """
+    from query import FlightQuery, json_loads
+    FlightQueryResult = FlightQuery.FlightQueryResult
+
+    def decode(contents):
+        return contents
+
+    def run_decode(contents):
+        return sum(len(json_loads(c)['Itineraries']) for c in contents)
+
+    def decoded(contents):
+        return [json_loads(c) for c in contents]
+
+    def run_parse(lazy, responses):
+        return sum(len(FlightQueryResult(r, lazy=lazy).lowest_prices) for r in responses)
+
+    def parsed(lazy, contents):
+        return [FlightQueryResult(json_loads(c), lazy=lazy) for c in contents]
+
+    def run_query(lazy, responses):
+        # Parsed and compacted as a cached query result, then ranked
+        n = 0
+        for r in responses:
+            result = FlightQueryResult(r, lazy=lazy)
+            result.compact()
+            result.get_lowest_price()
+            n += len(result.lowest_prices)
+        return n
+
+    def run_rank(results):
+        for r in results:
+            r.get_lowest_price()
+        return sum(len(r.lowest_prices) for r in results)
+
+    def run_rank_filtered(results):
+        for r in results:
+            r.get_lowest_price(itinerary_filter=filter)
+        return sum(len(r.lowest_prices) for r in results)
+
+    def run_to_dict(results):
+        return sum(len([r.to_dict(i) for i in r.Itineraries]) for r in results)
+
+    def run_filter(results):
+        return sum(len([i for i in r.Itineraries if filter(r, i)]) for r in results)
+
+    def ranked(contents):
+        return [r.get_lowest_price() for r in parsed(True, contents)]
+
+    def run_merge(rankings):
+        return len(FlightQueryResult.merge_ranked(rankings))
+
+    return [('decode', decode, run_decode),
+            ('parse', decoded, partial(run_parse, False)),
+            ('parse_lazy', decoded, partial(run_parse, True)),
+            ('query', decoded, partial(run_query, False)),
+            ('query_lazy', decoded, partial(run_query, True)),
+            ('rank', partial(parsed, False), run_rank),
+            ('rank_lazy', partial(parsed, True), run_rank),
+            ('rank_filtered', partial(parsed, True), run_rank_filtered),
+            ('to_dict', partial(parsed, False), run_to_dict),
+            ('carrier_filter', partial(parsed, False), run_filter),
+            ('merge', ranked, run_merge)]
+
+
+def run_stage(setup, run, contents, repeat):
+    """
+    :return Dictionary of the stage statistics
+    """
+    latencies = []
+    n_processed = 0
+    for _ in range(repeat):
+        data = setup(contents)
+        gc.collect()
+        start = time.perf_counter()
+        n_processed = run(data)
+        latencies.append(time.perf_counter() - start)
+
+    # Peak memory is measured in a separate run as tracing slows it down
+    data = setup(contents)
+    gc.collect()
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'throughput_per_sec': n_processed / max(percentile(latencies, 50), 1e-9),
+            'peak_memory_kb': peak / 1024.0}
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return List of the regressions, i.e. the stages whose median latency is
+            above the baseline by more than the tolerance
+    """
+    regressions = []
+    for case, stages in report.items():
+        for stage, stats in stages.items():
+            base = baseline.get(case, {}).get(stage)
+            if base is not None and stats['p50_ms'] > base['p50_ms'] * (1.0 + tolerance):
+                regressions.append("%s %s: p50 %.3f ms > baseline %.3f ms" %
+                                   (case, stage, stats['p50_ms'], base['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the query result pipeline")
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help="Number of itineraries per synthetic response, separated by comma")
+    parser.add_argument('--routes', type=int, default=5,
+                        help="Number of responses per search, i.e. routes and dates")
+    parser.add_argument('--repeat', type=int, default=20, help="Number of timed runs per stage")
+    parser.add_argument('--records', help="Directory of responses recorded by HTTP_TRANSPORT = record")
+    parser.add_argument('--carrier-filter', default='-China', help="Carrier filter, as in the search form")
+    parser.add_argument('--baseline', help="Baseline report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed relative regression of the median latency")
+    parser.add_argument('--save', help="Save the report to this file, e.g. as a new baseline")
+    args = parser.parse_args()
+
+    filter = ItineraryFilter(carrier_filter=args.carrier_filter)
+
+    cases = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        cases.append(("synthetic_%dx%d" % (args.routes, size),
+                      [json.dumps(generate_response(size, seed=n)) for n in range(args.routes)]))
+    if args.records:
+        cases.append(("recorded", load_recorded(args.records)))
+
+    report = {}
+    for case, contents in cases:
+        if len(contents) == 0:
+            continue
+        report[case] = {}
+        for stage, setup, run in build_stages(filter):
+            stats = run_stage(setup, run, contents, args.repeat)
+            report[case][stage] = stats
+            print("%-20s %-16s p50 %9.3f ms  p95 %9.3f ms  p99 %9.3f ms  %12.0f itin/s  peak %9.1f KB" %
+                  (case, stage, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                   stats['throughput_per_sec'], stats['peak_memory_kb']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r in regressions:
+            print("REGRESSION %s" % r)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from db import connect_sqlite
+
+
+class QueryCache:
+    """
+    Two tier cache of live pricing results. The memory tier is an LRU of
+    parsed results and the sqlite tier keeps the raw responses, so that they
+    survive a restart and are shared with other processes. The memory tier
+    has its own lock, so a lookup never waits for the sqlite I/O, which is
+    serialized on the connection lock.
+    """
+    def __init__(self, parse, sqlite_file_path='', ttl_sec=900, route_ttl_sec=None,
+                 max_entries=256, max_db_entries=10000, partial_ttl_sec=60):
+        """
+        :param parse - Callable converting a raw response in json into the
+                       cached result
+        :param sqlite_file_path - Sqlite file path, memory only if empty
+        :param ttl_sec - Default time to live of an entry in seconds
+        :param route_ttl_sec - Dictionary of (origin, destination) to time to live
+        :param max_entries - Maximum number of entries in memory
+        :param max_db_entries - Maximum number of entries in sqlite
+        :param partial_ttl_sec - Maximum time to live of the result of a
+                                 session returned before it was complete
+        """
+        self.parse = parse
+        self.ttl_sec = ttl_sec
+        self.route_ttl_sec = route_ttl_sec or {}
+        self.max_entries = max_entries
+        self.max_db_entries = max_db_entries
+        self.partial_ttl_sec = partial_ttl_sec
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = None
+        if sqlite_file_path:
+            self.conn = connect_sqlite(sqlite_file_path)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS query_cache ("
+                              "key TEXT PRIMARY KEY, "
+                              "route TEXT, "
+                              "created_at REAL, "
+                              "expires_at REAL, "
+                              "response TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS query_cache_created_at "
+                              "ON query_cache (created_at)")
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(origin, destination, outbounddate, inbounddate, adults, market, currency):
+        """
+        :return The cache key of a live pricing query
+        """
+        return "|".join(str(e) for e in [origin, destination, outbounddate, inbounddate,
+                                         adults, market, currency])
+
+    def get_ttl_sec(self, origin, destination):
+        """
+        :return Time to live of the route in seconds
+        """
+        return self.route_ttl_sec.get((origin, destination), self.ttl_sec)
+
+    def get(self, key):
+        """
+        :param key - Cache key
+        :return The cached result, or None if it is missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+
+        if self.conn is not None:
+            with self.db_lock:
+                row = self.conn.execute("SELECT expires_at, response FROM query_cache "
+                                        "WHERE key = ? AND expires_at > ?",
+                                        (key, now)).fetchone()
+            if row is not None:
+                result = self.parse(row[1])
+                with self.lock:
+                    self._put_memory(key, row[0], result)
+                    self.db_hits += 1
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, origin, destination, response, result, complete=True):
+        """
+        :param key - Cache key
+        :param origin - Origin place of the query
+        :param destination - Destination place of the query
+        :param response - Raw response, stored in sqlite
+        :param result - Parsed result, stored in memory
+        :param complete - False if the session was returned before it was
+                          complete, which is then kept for partial_ttl_sec
+                          at most
+        """
+        ttl_sec = self.get_ttl_sec(origin, destination)
+        if not complete:
+            ttl_sec = min(ttl_sec, self.partial_ttl_sec)
+        if ttl_sec <= 0:
+            return
+
+        now = time.time()
+        expires_at = now + ttl_sec
+        with self.lock:
+            self._put_memory(key, expires_at, result)
+
+        if self.conn is not None:
+            content = json.dumps(response)
+            with self.db_lock:
+                self.conn.execute("INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?)",
+                                  (key, "%s-%s" % (origin, destination), now, expires_at, content))
+                self.conn.execute("DELETE FROM query_cache WHERE expires_at <= ?", (now,))
+                self.conn.execute("DELETE FROM query_cache WHERE key IN ("
+                                  "SELECT key FROM query_cache ORDER BY created_at DESC "
+                                  "LIMIT -1 OFFSET ?)", (self.max_db_entries,))
+                self.conn.commit()
+
+    def warm(self):
+        """
+        Load the most recent unexpired results of the sqlite tier into memory,
+        e.g. those cached by another worker or before a restart
+        :return Number of results loaded
+        """
+        if self.conn is None:
+            return 0
+
+        with self.db_lock:
+            rows = self.conn.execute("SELECT key, expires_at, response FROM query_cache "
+                                     "WHERE expires_at > ? ORDER BY created_at DESC LIMIT ?",
+                                     (time.time(), self.max_entries)).fetchall()
+        # The most recent result is inserted last, as the most recently used
+        results = [(key, expires_at, self.parse(response)) for key, expires_at, response in reversed(rows)]
+        with self.lock:
+            for key, expires_at, result in results:
+                self._put_memory(key, expires_at, result)
+
+        return len(rows)
+
+    def _put_memory(self, key, expires_at, result):
+        """
+        Insert into the memory tier and evict the least recently used entries.
+        The lock is held by the caller.
+        """
+        self.entries[key] = (expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        :return Dictionary of the cache counters
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'db_hits': self.db_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries)}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key. The first caller runs the
+    call and the others wait for it and share its result.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        :param key - Call key
+        :param fn - Callable without argument
+        :return The result of fn, shared by the concurrent callers of the key
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except Exception as ex:
+            future.set_exception(ex)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result()
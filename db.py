@@ -0,0 +1,16 @@
+import sqlite3
+
+
+def connect_sqlite(sqlite_file_path, busy_timeout_sec=10):
+    """
+    Connect to the sqlite file shared by the threads and the worker processes.
+    In WAL mode the readers do not block the writer, and a writer waits for
+    the lock up to the busy timeout instead of failing at once.
+    :param sqlite_file_path - Sqlite file path
+    :param busy_timeout_sec - Time to wait for the lock of another connection
+    :return Connection
+    """
+    conn = sqlite3.connect(sqlite_file_path, timeout=busy_timeout_sec, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,246 @@
+import csv
+import heapq
+import importlib.util
+import io
+import sys
+from datetime import datetime, timedelta, timezone
+from db import connect_sqlite
+
+
+ITINERARY_COLUMNS = [('query', 'str'), ('price', 'float')] + \
+                    [('%s_%s' % (leg, field), 'str')
+                     for leg in ('outbound', 'inbound')
+                     for field in ('origin', 'destination', 'departure', 'arrival', 'carriers', 'stops')]
+
+HISTORY_COLUMNS = [('route', 'str'),
+                   ('origin', 'str'),
+                   ('destination', 'str'),
+                   ('outbound_date', 'str'),
+                   ('inbound_date', 'str'),
+                   ('observed_at', 'float'),
+                   ('price', 'float'),
+                   ('carriers', 'str')]
+
+MIME_TYPES = {'csv': 'text/csv',
+              'parquet': 'application/vnd.apache.parquet',
+              'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+def get_formats():
+    """
+    :return List of the export formats, the columnar ones only if pyarrow
+            is installed
+    """
+    # Looked up without importing pyarrow, which is slow to import
+    return ['csv', 'parquet', 'arrow'] if importlib.util.find_spec('pyarrow') is not None else ['csv']
+
+
+def chunked(rows, chunk_size):
+    """
+    :param rows - Iterable of rows
+    :param chunk_size - Number of rows per chunk
+    :return Generator of the lists of rows
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def itinerary_rows(results):
+    """
+    Flatten the ranked itineraries of the query results, sorted by price
+    across the queries
+    :param results - List of (query, itineraries sorted by price)
+    :return Generator of the rows in ITINERARY_COLUMNS
+    """
+    ranked = [[(query, i) for i in itineraries] for query, itineraries in results]
+    for query, itinerary in heapq.merge(*ranked, key=lambda r: r[1]['Price']):
+        row = [query, itinerary['Price']]
+        for leg in (itinerary['OutboundLeg'], itinerary['InboundLeg']):
+            if leg is None:
+                row += [None] * 6
+            else:
+                row += [leg['OriginStation'], leg['DestinationStation'], leg['Departure'], leg['Arrival'],
+                        ";".join(leg['Carriers']), ";".join(leg['Stops'])]
+        yield row
+
+
+def history_chunks(sqlite_file_path, origin=None, destination=None, since=None, until=None, chunk_size=10000):
+    """
+    Read the price history in chunks, so the memory is bounded by the chunk
+    size rather than the number of rows
+    :param sqlite_file_path - Sqlite file path of the price history
+    :param origin - Origin place ID, all if None
+    :param destination - Destination place ID, all if None
+    :param since - First observation date in %Y-%m-%d UTC, inclusive
+    :param until - Last observation date in %Y-%m-%d UTC, inclusive
+    :param chunk_size - Number of rows per chunk
+    :return Generator of the lists of rows in HISTORY_COLUMNS
+    """
+    sql = "SELECT %s FROM price_history" % ", ".join(c for c, _ in HISTORY_COLUMNS)
+    conditions = []
+    params = []
+    if origin:
+        conditions.append("origin = ?")
+        params.append(origin)
+    if destination:
+        conditions.append("destination = ?")
+        params.append(destination)
+    if since:
+        conditions.append("observed_at >= ?")
+        params.append(datetime.strptime(since, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+    if until:
+        conditions.append("observed_at < ?")
+        params.append((datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)).replace(tzinfo=timezone.utc).timestamp())
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+
+    conn = connect_sqlite(sqlite_file_path)
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def iter_csv(columns, chunks):
+    """
+    :param columns - List of (name, type) of the columns
+    :param chunks - Iterable of the lists of rows
+    :return Generator of the CSV text, one piece per chunk
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([c for c, _ in columns])
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell() > 0:
+        yield buf.getvalue()
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file collecting the bytes written since the last drain
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        """
+        :return The bytes written since the last drain
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_arrow_schema(columns):
+    """
+    :param columns - List of (name, type) of the columns
+    :return Arrow schema
+    """
+    import pyarrow as pa
+    types = {'str': pa.string(), 'float': pa.float64(), 'int': pa.int64()}
+    return pa.schema([(c, types[t]) for c, t in columns])
+
+
+def iter_columnar(columns, chunks, format='parquet'):
+    """
+    Stream the rows in a columnar format, each chunk as a Parquet row group
+    or an Arrow record batch
+    :param columns - List of (name, type) of the columns
+    :param chunks - Iterable of the lists of rows
+    :param format - parquet or arrow
+    :return Generator of the bytes
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Format %s requires pyarrow" % format)
+
+    schema = get_arrow_schema(columns)
+    sink = ChunkSink()
+    if format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for chunk in chunks:
+        batch = pa.record_batch([list(c) for c in zip(*chunk)], schema=schema)
+        if format == 'parquet':
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+def iter_export(columns, chunks, format='csv'):
+    """
+    :param columns - List of (name, type) of the columns
+    :param chunks - Iterable of the lists of rows
+    :param format - One of get_formats()
+    :return Generator of the exported file content
+    """
+    if format not in get_formats():
+        raise ValueError("Unsupported export format %s, supported: %s" % (format, ", ".join(get_formats())))
+
+    if format == 'csv':
+        return iter_csv(columns, chunks)
+    return iter_columnar(columns, chunks, format)
+
+
+def export_history(sqlite_file_path, output_path, **kwargs):
+    """
+    Export the price history to a file, in the format of its extension
+    :param sqlite_file_path - Sqlite file path of the price history
+    :param output_path - Output file path, e.g. history.parquet
+    :param kwargs - Filters of history_chunks
+    """
+    format = output_path.rsplit('.', 1)[-1].lower()
+    content = iter_export(HISTORY_COLUMNS, history_chunks(sqlite_file_path, **kwargs), format)
+    if format == 'csv':
+        f = open(output_path, 'w', newline='')
+    else:
+        f = open(output_path, 'wb')
+    with f:
+        for data in content:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) > 5:
+        print("Usage: python export.py <sqlite file> <output file .csv/.parquet/.arrow> (<since> (<until>))")
+        sys.exit(1)
+
+    export_history(sys.argv[1], sys.argv[2],
+                   since=sys.argv[3] if len(sys.argv) > 3 else None,
+                   until=sys.argv[4] if len(sys.argv) > 4 else None)
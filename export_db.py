@@ -1,51 +1,303 @@
 import sys
-import sqlite3
-from query import FlightQuery, print_log
+import threading
+import time
+from alerts import create_alerts
+from db import connect_sqlite
+from settings import print_log
+from search import FlightSearch, SearchTask
 from datetime import datetime, timedelta
 
+
 class SqliteClient:
+    """
+    Price history store. Observations are buffered and written in batches,
+    one transaction per batch. The database runs in WAL mode so that the
+    dashboard can read while a sweep is writing.
+
+    Two aggregate tables are updated in the same transaction, so that the
+    analytics views never scan the raw observations:
+    - price_calendar: the latest and the lowest price of each route and
+      date pair
+    - price_trend: the lowest and the total price of each route and
+      observation day
+    The price calendar is also the index of the last and the lowest price
+    seen, which the price alerts compare each batch with.
+    """
     def __init__(self, conf):
+        """
+        :param conf - Configuration object
+        """
         self.conf = conf
+        self.batch_size = conf.get_history_batch_size()
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.alerts = create_alerts(conf)
         self.init()
-    
+
     def init(self):
-        self.conn = sqlite3.connect(self.conf.get_sqlite_file_path(), check_same_thread=False)
-        
+        self.conn = connect_sqlite(self.conf.get_sqlite_file_path())
+        self.conn.execute("CREATE TABLE IF NOT EXISTS price_history ("
+                          "route TEXT, "
+                          "origin TEXT, "
+                          "destination TEXT, "
+                          "outbound_date TEXT, "
+                          "inbound_date TEXT, "
+                          "observed_at REAL, "
+                          "price REAL, "
+                          "carriers TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS price_history_route "
+                          "ON price_history (route, outbound_date, inbound_date)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS price_history_outbound_date "
+                          "ON price_history (outbound_date)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS price_calendar ("
+                          "route TEXT, "
+                          "origin TEXT, "
+                          "destination TEXT, "
+                          "outbound_date TEXT, "
+                          "inbound_date TEXT, "
+                          "observed_at REAL, "
+                          "price REAL, "
+                          "min_price REAL, "
+                          "n INTEGER, "
+                          "PRIMARY KEY (route, outbound_date, inbound_date))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS price_calendar_origin "
+                          "ON price_calendar (origin, outbound_date)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS price_trend ("
+                          "route TEXT, "
+                          "origin TEXT, "
+                          "destination TEXT, "
+                          "day TEXT, "
+                          "min_price REAL, "
+                          "sum_price REAL, "
+                          "n INTEGER, "
+                          "PRIMARY KEY (route, day))")
+        self.conn.commit()
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python export_db.py <config_file>")
-        sys.exit(0)
-   
-    config_file_path = sys.argv[1]
-    flight = FlightQuery(config_file_path)
-    db_client = SqliteClient(flight.conf)
-    start_date = datetime.now() + timedelta(days=1)
-    search_days = 1 ## flight.conf.get_search_days()
-    departures = ['Hong Kong'] ## flight.conf.get_departure_cities()
-    destinations = ['London'] ## flight.conf.get_destination_cities()
-    departures_code = [flight.top_autosuggest(d) for d in departures]
-    destinations_code = [flight.top_autosuggest(d) for d in destinations]
-    travel_duration = flight.conf.get_travel_interval_days()
-    
-    for i in range(0, len(departures_code)):
-        if departures_code[i] == "":
-            print("Cannot find the city code of departure city %s" % departures[i])
-    
-    for i in range(0, len(destinations_code)):
-        if destinations_code[i] == "":
-            print("Cannot find the city code of destination city %s" % destinations[i])    
-    
-    for incr_day in range(0, search_days):
+        if self.conn.execute("SELECT COUNT(*) FROM price_calendar").fetchone()[0] == 0:
+            self.rebuild_aggregates()
+
+    def rebuild_aggregates(self):
+        """
+        Rebuild the aggregate tables from the raw observations, e.g. for a
+        price history written before the tables existed
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM price_calendar")
+            self.conn.execute("DELETE FROM price_trend")
+            self.conn.execute("INSERT INTO price_calendar "
+                              "SELECT h.route, h.origin, h.destination, h.outbound_date, h.inbound_date, "
+                              "h.observed_at, MIN(h.price), a.min_price, a.n "
+                              "FROM price_history h JOIN ("
+                              "SELECT route, outbound_date, inbound_date, MAX(observed_at) AS observed_at, "
+                              "MIN(price) AS min_price, COUNT(*) AS n "
+                              "FROM price_history GROUP BY route, outbound_date, inbound_date) a "
+                              "ON h.route = a.route AND h.outbound_date = a.outbound_date "
+                              "AND h.inbound_date = a.inbound_date AND h.observed_at = a.observed_at "
+                              "GROUP BY h.route, h.outbound_date, h.inbound_date")
+            self.conn.execute("INSERT INTO price_trend "
+                              "SELECT route, origin, destination, date(observed_at, 'unixepoch'), "
+                              "MIN(price), SUM(price), COUNT(*) "
+                              "FROM price_history GROUP BY route, date(observed_at, 'unixepoch')")
+
+    def insert_prices(self, task, itineraries, observed_at=None):
+        """
+        Buffer the observed itineraries of a query
+        :param task - SearchTask of the query
+        :param itineraries - Readable itineraries of the query
+        :param observed_at - Observation time, now if None
+        """
+        if observed_at is None:
+            observed_at = time.time()
+
+        route = "%s-%s" % (task.dept_place, task.dest_place)
+        rows = [(route,
+                 task.dept_place,
+                 task.dest_place,
+                 task.outbounddate,
+                 task.inbounddate,
+                 observed_at,
+                 i['Price'],
+                 ", ".join(i['OutboundLeg']['Carriers'] + (i['InboundLeg'] or {}).get('Carriers', [])))
+                for i in itineraries]
+
+        alerts = []
+        with self.lock:
+            self.buffer += rows
+            if len(self.buffer) >= self.batch_size:
+                alerts = self._flush()
+
+        self.send_alerts(alerts)
+
+    def flush(self):
+        """
+        Write the buffered observations
+        """
+        with self.lock:
+            alerts = self._flush()
+
+        self.send_alerts(alerts)
+
+    def send_alerts(self, alerts):
+        """
+        Send the alerts of a batch, outside the lock so that a slow sink does
+        not hold up the writes
+        """
+        if self.alerts is not None:
+            self.alerts.send(alerts)
+
+    def _flush(self):
+        """
+        :return List of the price alerts of the batch
+        """
+        if len(self.buffer) == 0:
+            return []
+
+        calendar = {}
+        trend = {}
+        for route, origin, destination, outbound_date, inbound_date, observed_at, price, _ in self.buffer:
+            key = (route, outbound_date, inbound_date)
+            entry = calendar.get(key)
+            if entry is None:
+                calendar[key] = [route, origin, destination, outbound_date, inbound_date,
+                                 observed_at, price, price, 1]
+            else:
+                if observed_at > entry[5] or (observed_at == entry[5] and price < entry[6]):
+                    entry[5] = observed_at
+                    entry[6] = price
+                entry[7] = min(entry[7], price)
+                entry[8] += 1
+
+            day = time.strftime("%Y-%m-%d", time.gmtime(observed_at))
+            entry = trend.get((route, day))
+            if entry is None:
+                trend[(route, day)] = [route, origin, destination, day, price, price, 1]
+            else:
+                entry[4] = min(entry[4], price)
+                entry[5] += price
+                entry[6] += 1
+
+        previous = {}
+        if self.alerts is not None:
+            # Primary key lookups of the route and date pairs in the batch only
+            for key in calendar:
+                row = self.conn.execute("SELECT price, min_price FROM price_calendar "
+                                        "WHERE route = ? AND outbound_date = ? AND inbound_date = ?",
+                                        key).fetchone()
+                if row is not None:
+                    previous[key] = row
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO price_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.buffer)
+            # On conflict the expressions on the right refer to the stored row
+            self.conn.executemany("INSERT INTO price_calendar VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                                  "ON CONFLICT (route, outbound_date, inbound_date) DO UPDATE SET "
+                                  "price = CASE WHEN excluded.observed_at >= observed_at "
+                                  "THEN excluded.price ELSE price END, "
+                                  "observed_at = MAX(observed_at, excluded.observed_at), "
+                                  "min_price = MIN(min_price, excluded.min_price), "
+                                  "n = n + excluded.n",
+                                  calendar.values())
+            self.conn.executemany("INSERT INTO price_trend VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                  "ON CONFLICT (route, day) DO UPDATE SET "
+                                  "min_price = MIN(min_price, excluded.min_price), "
+                                  "sum_price = sum_price + excluded.sum_price, "
+                                  "n = n + excluded.n",
+                                  trend.values())
+        self.buffer = []
+
+        if self.alerts is None:
+            return []
+        return self.alerts.detect(previous, calendar)
+
+    def close(self):
+        """
+        Flush and close the connection
+        """
+        self.flush()
+        self.conn.close()
+
+
+def build_monitor_grid(conf, place_resolver, start_date):
+    """
+    Build the monitoring grid from the configuration, i.e. departure and
+    destination cities, SEARCH_DAYS outbound dates and TRAVEL_INTERVAL_DAYS
+    durations.
+    :param conf - Configuration object
+    :param place_resolver - PlaceResolver object
+    :param start_date - First outbound date
+    :return List of SearchTask
+    """
+    departures = conf.get_departure_cities()
+    destinations = conf.get_destination_cities()
+    travel_duration = conf.get_travel_interval_days()
+    places = place_resolver.resolve_all(departures + destinations)
+
+    for city in departures + destinations:
+        if places[city] == "":
+            print("Cannot find the city code of city %s" % city)
+
+    departures_code = [places[d] for d in departures if places[d] != ""]
+    destinations_code = [places[d] for d in destinations if places[d] != ""]
+
+    tasks = []
+    for incr_day in range(0, conf.get_search_days()):
         for duration in range(travel_duration[0], travel_duration[1]+1):
             for departure in departures_code:
                 for destination in destinations_code:
                     start = start_date + timedelta(days=incr_day)
                     end = start_date + timedelta(days=incr_day+duration)
-                    result = flight.Query(dept_place=departure,
-                                          dest_place=destination,
-                                          outbounddate=start.strftime("%Y-%m-%d"),
-                                          inbounddate=end.strftime("%Y-%m-%d"))
-                    print(result.get_lowest_price())
-    
-    
+                    tasks.append(SearchTask(dept_place=departure,
+                                            dest_place=destination,
+                                            outbounddate=start.strftime("%Y-%m-%d"),
+                                            inbounddate=end.strftime("%Y-%m-%d")))
+
+    return tasks
+
+
+def sweep(flight_search, db_client, tasks):
+    """
+    Run the queries and store the observed prices. The FlightQuery of the
+    search should price live and require complete sessions, see main.
+    :param flight_search - FlightSearch object
+    :param db_client - SqliteClient object
+    :param tasks - List of SearchTask
+    :return Number of queries completed
+    """
+    done = 0
+    for task, itineraries in flight_search.iter_results(tasks):
+        db_client.insert_prices(task, itineraries)
+        done += 1
+
+    db_client.flush()
+    return done
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 3 or (len(sys.argv) == 3 and sys.argv[2] not in ("--daemon", "--once")):
+        print("Usage: python export_db.py <config_file> (--daemon|--once)")
+        sys.exit(0)
+
+    config_file_path = sys.argv[1]
+    if len(sys.argv) == 3 and sys.argv[2] == "--once":
+        from monitor import run_monitor_once
+        run_monitor_once(config_file_path)
+        sys.exit(0)
+
+    # The API client is only loaded when it is needed
+    from query import FlightQuery
+    flight = FlightQuery(config_file_path)
+    # A partial session or a cached result would be stored as the price
+    # observed now
+    flight.require_complete = True
+    flight.use_cache = False
+    if len(sys.argv) == 3:
+        from monitor import run_monitor
+        run_monitor(flight)
+        sys.exit(0)
+
+    db_client = SqliteClient(flight.conf)
+    tasks = build_monitor_grid(flight.conf, flight.places, datetime.now() + timedelta(days=1))
+    done = sweep(FlightSearch(flight), db_client, tasks)
+    print_log("Default", "main", "Stored prices of %d / %d queries", done, len(tasks))
+    db_client.close()
@@ -0,0 +1,118 @@
+import copy
+import threading
+import weakref
+
+
+class ItineraryFilter:
+    """
+    Itinerary filter compiled once per search. The carrier terms, e.g.
+    "China,-Emirates", are resolved once per query result into sets of
+    carrier IDs, so filtering an itinerary is a set lookup on the carrier
+    IDs of its legs and no readable dictionary is built.
+    """
+    def __init__(self, carrier_filter='', max_stops=None, depart_after=None,
+                 depart_before=None, max_price=None):
+        """
+        :param carrier_filter - Carrier name terms separated by comma. The
+                                itinerary must have a carrier matching one of
+                                the terms, or if all the terms start with '-',
+                                none of its carriers can match them.
+        :param max_stops - Maximum number of stops per leg
+        :param depart_after - Earliest outbound departure time, e.g. 08:00
+        :param depart_before - Latest outbound departure time, e.g. 22:00
+        :param max_price - Maximum price
+        """
+        terms = [c.strip() for c in carrier_filter.split(',')]
+        self.welcome_carriers = [c for c in terms if len(c) > 0 and c[0] != '-']
+        self.unwelcome_carriers = [c[1:] for c in terms if len(c) > 0 and c[0] == '-']
+        self.max_stops = max_stops
+        self.depart_after = depart_after
+        self.depart_before = depart_before
+        self.max_price = max_price
+        self.bound = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def for_return_leg(self):
+        """
+        :return Filter of the return leg of an open jaw trip, which is
+                searched as a one way query. The departure time window only
+                applies to the outbound leg.
+        """
+        ret = self.copy()
+        ret.depart_after = None
+        ret.depart_before = None
+        return ret
+
+    def without_carriers(self):
+        """
+        :return Filter without the carrier terms. An open jaw trip only
+                needs a welcome carrier on either leg, as a round trip, so its
+                one way legs are also ranked without them. The unwelcome
+                terms are ignored anyway once there is a welcome term.
+        """
+        ret = self.copy()
+        ret.welcome_carriers = []
+        ret.unwelcome_carriers = []
+        return ret
+
+    def copy(self):
+        """
+        :return Copy of the filter with its own carrier ID sets per result
+        """
+        ret = copy.copy(self)
+        ret.bound = weakref.WeakKeyDictionary()
+        ret.lock = threading.Lock()
+        return ret
+
+    def bind(self, result):
+        """
+        :param result - FlightQueryResult
+        :return Tuple of the welcome and unwelcome carrier ID sets of the result
+        """
+        ids = self.bound.get(result)
+        if ids is not None:
+            return ids
+
+        with self.lock:
+            ids = self.bound.get(result)
+            if ids is None:
+                carriers = [(k, result.Carriers[k].Name) for k in result.Carriers]
+                ids = (frozenset(k for k, name in carriers
+                                 if any(name.find(c) > -1 for c in self.welcome_carriers)),
+                       frozenset(k for k, name in carriers
+                                 if any(name.find(c) > -1 for c in self.unwelcome_carriers)))
+                self.bound[result] = ids
+            return ids
+
+    def __call__(self, result, itinerary):
+        """
+        :param result - FlightQueryResult of the itinerary
+        :param itinerary - FlightItinerary
+        :return True if it passes the filtering
+        """
+        if self.max_price is not None and itinerary.LowestPrice > self.max_price:
+            return False
+
+        outbound = result.Legs[itinerary.OutboundLegId]
+        # A one way itinerary is checked on its outbound leg twice
+        inbound = outbound if itinerary.InboundLegId is None else result.Legs[itinerary.InboundLegId]
+
+        if self.max_stops is not None and \
+                (len(outbound.Stops) > self.max_stops or len(inbound.Stops) > self.max_stops):
+            return False
+
+        if self.depart_after is not None and outbound.Departure[11:16] < self.depart_after:
+            return False
+        if self.depart_before is not None and outbound.Departure[11:16] > self.depart_before:
+            return False
+
+        if len(self.welcome_carriers) > 0:
+            welcome_ids = self.bind(result)[0]
+            return not welcome_ids.isdisjoint(outbound.Carriers) or \
+                not welcome_ids.isdisjoint(inbound.Carriers)
+        elif len(self.unwelcome_carriers) > 0:
+            unwelcome_ids = self.bind(result)[1]
+            return unwelcome_ids.isdisjoint(outbound.Carriers) and \
+                unwelcome_ids.isdisjoint(inbound.Carriers)
+        else:
+            return True
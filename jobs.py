@@ -0,0 +1,457 @@
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from db import connect_sqlite
+from query import FlightQuery
+from settings import print_log
+
+
+class SearchJob:
+    """
+    A search running in the background. The lowest price itineraries of each
+    query are appended as the queries complete.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id, key, prepare, store=None):
+        """
+        :param job_id - Job ID
+        :param key - Key of the search conditions
+        :param prepare - Function returning the dictionary of the search
+                         tasks and the itinerary filter, called by the worker
+        :param store - JobStore sharing the job with the other processes
+        """
+        self.id = job_id
+        self.key = key
+        self.prepare = prepare
+        self.state = SearchJob.QUEUED
+        self.total = None
+        self.results = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancelled = threading.Event()
+        self.condition = threading.Condition()
+        self.store = store
+
+    @property
+    def finished(self):
+        return self.state in (SearchJob.DONE, SearchJob.FAILED, SearchJob.CANCELLED)
+
+    def start(self, total):
+        """
+        :param total - Number of queries of the search
+        """
+        with self.condition:
+            self.total = total
+            if self.store is not None:
+                self.store.save(self)
+            self.condition.notify_all()
+
+    def add_result(self, query, itineraries):
+        """
+        :param query - Readable query, e.g. HKGA-sky-LOND-sky@2017-03-01/2017-03-08
+        :param itineraries - Lowest price itineraries of the query
+        """
+        with self.condition:
+            self.results.append((query, itineraries))
+            if self.store is not None:
+                self.store.add_result(self.id, len(self.results) - 1, query, itineraries)
+            self.condition.notify_all()
+
+    def set_state(self, state, error=None):
+        with self.condition:
+            self.state = state
+            self.error = error
+            if self.finished:
+                self.finished_at = time.time()
+            if self.store is not None:
+                self.store.save(self)
+            self.condition.notify_all()
+
+    def wait(self, n_results, timeout):
+        """
+        Wait for more results than n_results or the end of the job
+        :return True if there is anything new
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.results) > n_results or self.finished,
+                                           timeout)
+
+    def status(self, since=0, merged=True):
+        """
+        :param since - Number of query results already received by the client
+        :param merged - If True, all the itineraries so far are also merged
+                        and sorted by price
+        :return Dictionary of the job status and the query results from since
+        """
+        with self.condition:
+            results = list(self.results)
+            status = {'id': self.id,
+                      'state': self.state,
+                      'done': len(results),
+                      'total': self.total,
+                      'error': self.error,
+                      'created_at': self.created_at,
+                      'finished_at': self.finished_at,
+                      'results': [{'query': q, 'itineraries': i} for q, i in results[since:]]}
+
+        if merged:
+            status['itineraries'] = FlightQuery.FlightQueryResult.merge_ranked([i for _, i in results])
+        return status
+
+
+class StoredJob(SearchJob):
+    """
+    Read-only view of a job run by another worker process, refreshed from
+    the job store
+    """
+    POLL_SEC = 1.0
+
+    def refresh(self):
+        self.store.refresh(self)
+
+    def wait(self, n_results, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self.refresh()
+            if len(self.results) > n_results or self.finished:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(self.POLL_SEC, max(0, deadline - time.time())))
+
+    def status(self, since=0, merged=True):
+        self.refresh()
+        return SearchJob.status(self, since, merged)
+
+
+class JobStore:
+    """
+    Sqlite store of the search jobs, so that a job submitted to one worker
+    process can be polled, streamed and cancelled through any of them. The
+    owner of an unfinished job updates it periodically, and a job not
+    updated for STALE_SEC, e.g. of a killed worker, is failed.
+    """
+    HEARTBEAT_SEC = 10.0
+    STALE_SEC = 60.0
+
+    def __init__(self, sqlite_file_path, owner=None):
+        """
+        :param sqlite_file_path - Sqlite file path
+        :param owner - ID of the process running the jobs saved by this store
+        """
+        self.owner = owner or uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.conn = connect_sqlite(sqlite_file_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS search_job ("
+                          "id TEXT PRIMARY KEY, "
+                          "key TEXT, "
+                          "state TEXT, "
+                          "total INTEGER, "
+                          "error TEXT, "
+                          "created_at REAL, "
+                          "finished_at REAL, "
+                          "cancel_requested INTEGER DEFAULT 0, "
+                          "owner TEXT, "
+                          "updated_at REAL)")
+        # Tables created before the heartbeat
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(search_job)")]
+        for column, column_type in (('owner', 'TEXT'), ('updated_at', 'REAL')):
+            if column not in columns:
+                self.conn.execute("ALTER TABLE search_job ADD COLUMN %s %s" % (column, column_type))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS search_job_key ON search_job (key)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS search_job_result ("
+                          "job_id TEXT, "
+                          "n INTEGER, "
+                          "query TEXT, "
+                          "itineraries TEXT, "
+                          "PRIMARY KEY (job_id, n))")
+        self.conn.commit()
+
+    def save(self, job):
+        """
+        Insert or update the state of the job
+        """
+        with self.lock:
+            self.conn.execute("INSERT INTO search_job (id, key, state, total, error, created_at, finished_at, "
+                              "owner, updated_at) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                              "ON CONFLICT (id) DO UPDATE SET state = excluded.state, "
+                              "total = excluded.total, error = excluded.error, "
+                              "finished_at = excluded.finished_at, updated_at = excluded.updated_at",
+                              (job.id, job.key, job.state, job.total, job.error,
+                               job.created_at, job.finished_at, self.owner, time.time()))
+            self.conn.commit()
+
+    def add_result(self, job_id, n, query, itineraries):
+        """
+        :param n - Index of the query result in the job
+        """
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO search_job_result VALUES (?, ?, ?, ?)",
+                              (job_id, n, query, json.dumps(itineraries)))
+            self.conn.execute("UPDATE search_job SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+            self.conn.commit()
+
+    def heartbeat(self):
+        """
+        Mark the unfinished jobs of this owner as alive
+        """
+        with self.lock:
+            self.conn.execute("UPDATE search_job SET updated_at = ? WHERE owner = ? AND finished_at IS NULL",
+                              (time.time(), self.owner))
+            self.conn.commit()
+
+    def fail_stale(self):
+        """
+        Fail the unfinished jobs not updated for STALE_SEC, whose worker is
+        gone
+        :return Number of the jobs failed
+        """
+        now = time.time()
+        with self.lock:
+            n = self.conn.execute("UPDATE search_job SET state = ?, error = ?, finished_at = ? "
+                                  "WHERE finished_at IS NULL AND (updated_at IS NULL OR updated_at < ?)",
+                                  (SearchJob.FAILED, "The worker running the job stopped", now,
+                                   now - self.STALE_SEC)).rowcount
+            self.conn.commit()
+        return n
+
+    def find(self, key, min_finished_at):
+        """
+        :return ID of the latest job of the search conditions which is
+                still running or kept, or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT id FROM search_job WHERE key = ? "
+                                    "AND state NOT IN (?, ?) "
+                                    "AND (finished_at IS NULL OR finished_at >= ?) "
+                                    "ORDER BY created_at DESC LIMIT 1",
+                                    (key, SearchJob.FAILED, SearchJob.CANCELLED, min_finished_at)).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, job_id, min_finished_at):
+        """
+        :return StoredJob, or None if it is unknown or expired
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT key, created_at FROM search_job WHERE id = ? "
+                                    "AND (finished_at IS NULL OR finished_at >= ?)",
+                                    (job_id, min_finished_at)).fetchone()
+        if row is None:
+            return None
+
+        job = StoredJob(job_id, row[0], None, store=self)
+        job.created_at = row[1]
+        self.refresh(job)
+        return job
+
+    def refresh(self, job):
+        """
+        Load the state and the new query results of the StoredJob
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT state, total, error, finished_at, updated_at FROM search_job "
+                                    "WHERE id = ?", (job.id,)).fetchone()
+            rows = self.conn.execute("SELECT query, itineraries FROM search_job_result "
+                                     "WHERE job_id = ? AND n >= ? ORDER BY n",
+                                     (job.id, len(job.results))).fetchall()
+        with job.condition:
+            job.state, job.total, job.error, job.finished_at, updated_at = row
+            if job.finished_at is None and (updated_at is None or updated_at < time.time() - self.STALE_SEC):
+                # Failed by the next fail_stale
+                job.state, job.error, job.finished_at = \
+                    SearchJob.FAILED, "The worker running the job stopped", time.time()
+            job.results += [(query, json.loads(itineraries)) for query, itineraries in rows]
+
+    def request_cancel(self, job_id):
+        with self.lock:
+            self.conn.execute("UPDATE search_job SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            self.conn.commit()
+
+    def cancel_requested(self, job_id):
+        with self.lock:
+            row = self.conn.execute("SELECT cancel_requested FROM search_job WHERE id = ?",
+                                    (job_id,)).fetchone()
+        return row is not None and row[0] == 1
+
+    def expire(self, min_finished_at):
+        """
+        Delete the jobs finished before min_finished_at
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM search_job_result WHERE job_id IN ("
+                              "SELECT id FROM search_job WHERE finished_at < ?)", (min_finished_at,))
+            self.conn.execute("DELETE FROM search_job WHERE finished_at < ?", (min_finished_at,))
+            self.conn.commit()
+
+
+class JobManager:
+    """
+    Runs the searches in a pool of background workers fed by a bounded queue.
+    A finished job is kept for the result TTL, and submitting the same search
+    again within it returns the same job instead of querying again.
+    """
+    def __init__(self, flight_search, max_workers=2, max_queued=16, result_ttl_sec=3600,
+                 sqlite_file_path=''):
+        """
+        :param flight_search - FlightSearch object
+        :param max_workers - Number of searches running at the same time
+        :param max_queued - Number of searches waiting for a worker
+        :param result_ttl_sec - Time to keep a finished job in seconds
+        :param sqlite_file_path - Sqlite file sharing the jobs with the other
+                                  worker processes, this process only if empty
+        """
+        self.flight_search = flight_search
+        self.result_ttl_sec = result_ttl_sec
+        self.store = JobStore(sqlite_file_path) if sqlite_file_path else None
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.jobs = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, name="search-job-%d" % n, daemon=True)
+                        for n in range(max_workers)]
+        if self.store is not None:
+            # The jobs left unfinished by a killed or restarted worker
+            n_stale = self.store.fail_stale()
+            if n_stale > 0:
+                print_log(self.__class__.__name__, "__init__", "Failed %d stale jobs", n_stale,
+                          level=logging.WARNING)
+            self.workers.append(threading.Thread(target=self.heartbeat, name="search-job-heartbeat",
+                                                 daemon=True))
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, key, prepare):
+        """
+        :param key - Key of the search conditions
+        :param prepare - Function returning the dictionary of the search
+                         tasks and the itinerary filter
+        :return SearchJob. queue.Full is raised if too many jobs are waiting.
+        """
+        with self.lock:
+            self.expire()
+            job = self.keys.get(key)
+            if job is not None and job.state not in (SearchJob.FAILED, SearchJob.CANCELLED):
+                return job
+
+            if self.store is not None:
+                min_finished_at = time.time() - self.result_ttl_sec
+                self.store.expire(min_finished_at)
+                self.store.fail_stale()
+                job_id = self.store.find(key, min_finished_at)
+                if job_id is not None:
+                    return self.store.load(job_id, min_finished_at)
+
+            job = SearchJob(uuid.uuid4().hex, key, prepare, store=self.store)
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            self.keys[key] = job
+            if self.store is not None:
+                self.store.save(job)
+            return job
+
+    def get(self, job_id):
+        """
+        :return SearchJob, or None if it is unknown or expired
+        """
+        with self.lock:
+            self.expire()
+            job = self.jobs.get(job_id)
+
+        if job is None and self.store is not None:
+            job = self.store.load(job_id, time.time() - self.result_ttl_sec)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job. A running job stops after its
+        running queries complete, keeping the results so far.
+        :return SearchJob, or None if it is unknown or expired
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+
+        if isinstance(job, StoredJob):
+            # The worker process running it checks the request after each query
+            job.store.request_cancel(job.id)
+            return job
+
+        job.cancelled.set()
+        if job.state == SearchJob.QUEUED:
+            job.set_state(SearchJob.CANCELLED)
+        return job
+
+    def expire(self):
+        """
+        Drop the finished jobs older than the result TTL. The lock is held
+        by the caller.
+        """
+        now = time.time()
+        expired = [job for job in self.jobs.values()
+                   if job.finished and job.finished_at + self.result_ttl_sec < now]
+        for job in expired:
+            del self.jobs[job.id]
+            if self.keys.get(job.key) is job:
+                del self.keys[job.key]
+
+    def heartbeat(self):
+        while True:
+            time.sleep(JobStore.HEARTBEAT_SEC)
+            try:
+                self.store.heartbeat()
+            except Exception as ex:
+                print_log(self.__class__.__name__, self.heartbeat.__name__, "Heartbeat failed: %s", ex,
+                          level=logging.ERROR)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if not job.cancelled.is_set():
+                    self.run(job)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job):
+        """
+        Run the search of the job
+        :param job - SearchJob
+        """
+        job.set_state(SearchJob.RUNNING)
+        try:
+            search = job.prepare()
+            job.start(len(search['tasks']))
+            results = self.flight_search.iter_results(search['tasks'],
+                                                      itinerary_filter=search['itinerary_filter'])
+            try:
+                for task, itineraries in results:
+                    job.add_result(repr(task), itineraries)
+                    if self.store is not None and self.store.cancel_requested(job.id):
+                        job.cancelled.set()
+                    if job.cancelled.is_set():
+                        break
+            finally:
+                # Pending queries are dropped when the generator is closed
+                results.close()
+
+            job.set_state(SearchJob.CANCELLED if job.cancelled.is_set() else SearchJob.DONE)
+        except Exception as ex:
+            print_log(self.__class__.__name__,
+                      self.run.__name__,
+                      "Job %s failed: %s", job.id, ex,
+                      level=logging.ERROR)
+            job.set_state(SearchJob.FAILED, str(ex))
+
+        print_log(self.__class__.__name__,
+                  self.run.__name__,
+                  "Job %s %s with %d / %s queries", job.id, job.state, len(job.results), job.total)
@@ -0,0 +1,165 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from benchmark import percentile
+
+
+def build_searches(n_searches, depts, dests, days, interval, seed=0):
+    """
+    Random search forms of the index page. The same seed gives the same
+    searches, so the runs of a comparison send the same load.
+    :param n_searches - Number of searches
+    :param depts - List of departure cities
+    :param dests - List of destination cities, each search picks one or two
+    :param days - Number of outbound dates per search
+    :param interval - Number of days between outbound and inbound
+    :param seed - Random seed
+    :return List of the forms
+    """
+    rnd = random.Random(seed)
+    today = datetime.now().date()
+    searches = []
+    for _ in range(n_searches):
+        start = today + timedelta(days=rnd.randrange(7, 90))
+        searches.append({'dept-city': rnd.choice(depts),
+                         'dest-city': ", ".join(rnd.sample(dests, min(len(dests), rnd.randint(1, 2)))),
+                         'dept-date': start.strftime("%Y-%m-%d"),
+                         'dest-date': (start + timedelta(days=days + interval - 1)).strftime("%Y-%m-%d"),
+                         'interval': str(interval),
+                         'carrier_filter': ''})
+    return searches
+
+
+def read_counters(url):
+    """
+    :param url - Dashboard URL
+    :return Dictionary of the counters of the dashboard metrics
+    """
+    return requests.get(url + "/metrics", params={'format': 'json'}, timeout=10).json()['counters']
+
+
+def run_search(session, url, form, timeout_sec, poll_sec=0.2):
+    """
+    Submit a search job and wait for it to finish. The page always returns
+    200, even if the search fails, so the job state tells if it succeeded.
+    :param session - HTTP session
+    :param url - Dashboard URL
+    :param form - Search form
+    :param timeout_sec - Timeout of the search
+    :param poll_sec - Interval between the polls of the job status
+    :return Final state of the job, or the error
+    """
+    deadline = time.perf_counter() + timeout_sec
+    resp = session.post(url + "/jobs", data=form, timeout=timeout_sec)
+    if resp.status_code != 202:
+        return "HTTP %d" % resp.status_code
+
+    status_url = url + resp.json()['url']
+    since = 0
+    while time.perf_counter() < deadline:
+        resp = session.get(status_url, params={'since': since}, timeout=timeout_sec)
+        if resp.status_code != 200:
+            return "HTTP %d" % resp.status_code
+        status = resp.json()
+        since += len(status['results'])
+        if status['state'] in ('done', 'failed', 'cancelled'):
+            return status['state'] if status['error'] is None else "%s: %s" % (status['state'], status['error'])
+        time.sleep(poll_sec)
+
+    return "timeout"
+
+
+def run_load(url, searches, concurrency, timeout_sec):
+    """
+    Run the searches as jobs concurrently
+    :param url - Dashboard URL
+    :param searches - List of the search forms
+    :param concurrency - Number of concurrent clients
+    :param timeout_sec - Timeout of a search
+    :return Tuple of the sorted latencies in seconds of the succeeded
+            searches, the list of the errors of the failed ones and the
+            elapsed time
+    """
+    local = threading.local()
+
+    def search(form):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            state = run_search(local.session, url, form, timeout_sec)
+        except (requests.RequestException, ValueError, KeyError) as ex:
+            state = str(ex)
+        return time.perf_counter() - start, state
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(search, searches))
+    elapsed = time.perf_counter() - start
+
+    return sorted(r[0] for r in results if r[1] == 'done'), [r[1] for r in results if r[1] != 'done'], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the dashboard search jobs. Run the dashboard "
+                                                 "on stub_server.py with API_HOST to load test it offline.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help="Dashboard URL")
+    parser.add_argument('--searches', type=int, default=50, help="Number of searches")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of concurrent clients")
+    parser.add_argument('--depts', default='Hong Kong', help="Departure cities, separated by comma")
+    parser.add_argument('--dests', default='London, Paris, Copenhagen, Madrid, Vienna',
+                        help="Destination cities, separated by comma")
+    parser.add_argument('--days', type=int, default=3, help="Number of outbound dates per search")
+    parser.add_argument('--interval', type=int, default=7, help="Number of days between outbound and inbound")
+    parser.add_argument('--timeout', type=float, default=300, help="Timeout of a search in seconds")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the searches")
+    parser.add_argument('--save', help="Save the report to this file")
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/')
+    searches = build_searches(args.searches,
+                              [c.strip() for c in args.depts.split(',')],
+                              [c.strip() for c in args.dests.split(',')],
+                              args.days, args.interval, args.seed)
+    # A failed query does not fail its search, so the API errors of the
+    # dashboard during the run are counted as well
+    try:
+        before = read_counters(url)
+    except (requests.RequestException, ValueError, KeyError) as ex:
+        print("Cannot read the dashboard metrics: %s" % ex)
+        sys.exit(1)
+    latencies, errors, elapsed = run_load(url, searches, args.concurrency, args.timeout)
+    after = read_counters(url)
+    counters = dict((k, after.get(k, 0) - before.get(k, 0)) for k in after)
+
+    report = {'searches': len(searches),
+              'failed': len(errors),
+              'errors': sorted(set(errors)),
+              'api_errors': counters.get('api_errors', 0),
+              'api_http_errors': counters.get('api_http_errors', 0),
+              'concurrency': args.concurrency,
+              'elapsed_sec': round(elapsed, 3),
+              'searches_per_sec': round(len(latencies) / elapsed, 3)}
+    if len(latencies) > 0:
+        report.update({'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                       'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                       'p99_ms': round(percentile(latencies, 99) * 1000, 1)})
+    # The API calls and the cache hits of the dashboard during the run
+    report['counters'] = counters
+
+    print(json.dumps(report, indent=4))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+    if report['failed'] > 0 or report['api_errors'] > 0 or report['api_http_errors'] > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """
+    Cumulative histogram of the observed values
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets - Sorted upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        :return List of (upper bound, cumulative count), ending with +Inf
+        """
+        ret = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+
+class Metrics:
+    """
+    Registry of the stage latency histograms, counters and gauges
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """
+        :param stage - Stage name
+        :param seconds - Latency in seconds
+        """
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[stage] = histogram
+            histogram.observe(seconds)
+
+    def incr(self, name, value=1):
+        """
+        Increase a counter
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge_add(self, name, value):
+        """
+        Add to a gauge, e.g. +1 when a call starts and -1 when it ends
+        """
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Time the block into the histogram of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        :return Dictionary of the current values
+        """
+        with self.lock:
+            return {'stages': dict((stage, {'count': h.count,
+                                            'sum': h.sum,
+                                            'buckets': h.cumulative_counts()})
+                                   for stage, h in self.histograms.items()),
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges)}
+
+    def to_prometheus(self, extra_counters=None, extra_gauges=None):
+        """
+        :param extra_counters - Dictionary of counters maintained elsewhere,
+                                e.g. the cache counters
+        :param extra_gauges - Dictionary of gauges maintained elsewhere
+        :return The metrics in the Prometheus text format
+        """
+        snapshot = self.snapshot()
+        lines = ['# TYPE skyscanner_stage_seconds histogram']
+        for stage, h in sorted(snapshot['stages'].items()):
+            for bound, count in h['buckets']:
+                lines.append('skyscanner_stage_seconds_bucket{stage="%s",le="%s"} %d' %
+                             (stage, bound, count))
+            lines.append('skyscanner_stage_seconds_sum{stage="%s"} %f' % (stage, h['sum']))
+            lines.append('skyscanner_stage_seconds_count{stage="%s"} %d' % (stage, h['count']))
+
+        counters = dict(snapshot['counters'])
+        counters.update(extra_counters or {})
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE skyscanner_%s_total counter' % name)
+            lines.append('skyscanner_%s_total %s' % (name, value))
+
+        gauges = dict(snapshot['gauges'])
+        gauges.update(extra_gauges or {})
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE skyscanner_%s gauge' % name)
+            lines.append('skyscanner_%s %s' % (name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,269 @@
+import heapq
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+from settings import config, print_log
+from places import PlaceResolver
+from search import FlightSearch
+from export_db import SqliteClient, build_monitor_grid
+
+
+class RequestBudget:
+    """
+    Token bucket limiting the API requests per minute across all threads.
+    The bucket holds only a small burst, so no 60 second window sees more
+    than the budget plus the burst.
+    """
+    def __init__(self, requests_per_minute, burst=1):
+        """
+        :param requests_per_minute - Maximum number of requests per minute
+        :param burst - Number of requests allowed at once
+        """
+        self.capacity = float(burst)
+        self.rate = float(requests_per_minute) / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """
+        Take a token, blocking until one is available
+        :param deadline - time.monotonic() after which no token is needed,
+                          unbounded if None
+        :return False if no token is available before the deadline, which
+                is then not waited for
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait = (1.0 - self.tokens) / self.rate
+
+            if deadline is not None and now + wait >= deadline:
+                return False
+            time.sleep(wait)
+
+
+class MonitorScheduler:
+    """
+    Refresh schedule of the monitored queries. The queries are kept in a
+    priority queue keyed on their next refresh time, which is persisted in
+    the monitor_schedule table so that a restarted monitor resumes where it
+    stopped. Near-term dates and volatile prices are refreshed more often.
+    """
+    def __init__(self, conn, min_refresh_sec, max_refresh_sec):
+        """
+        :param conn - Sqlite connection of the price history
+        :param min_refresh_sec - Minimum refresh interval in seconds
+        :param max_refresh_sec - Maximum refresh interval in seconds
+        """
+        self.conn = conn
+        self.min_refresh_sec = min_refresh_sec
+        self.max_refresh_sec = max_refresh_sec
+        self.queue = []
+        self.conn.execute("CREATE TABLE IF NOT EXISTS monitor_schedule ("
+                          "origin TEXT, "
+                          "destination TEXT, "
+                          "outbound_date TEXT, "
+                          "inbound_date TEXT, "
+                          "next_refresh REAL, "
+                          "PRIMARY KEY (origin, destination, outbound_date, inbound_date))")
+        self.conn.commit()
+
+    @staticmethod
+    def task_key(task):
+        return (task.dept_place, task.dest_place, task.outbounddate, task.inbounddate)
+
+    def load(self, tasks):
+        """
+        Schedule the tasks of the monitoring grid. Tasks with a persisted
+        refresh time resume from it, new tasks are due immediately and the
+        persisted tasks no longer in the grid are dropped.
+        :param tasks - List of SearchTask
+        """
+        persisted = dict(((r[0], r[1], r[2], r[3]), r[4]) for r in
+                         self.conn.execute("SELECT origin, destination, outbound_date, "
+                                           "inbound_date, next_refresh FROM monitor_schedule"))
+        now = time.time()
+        self.queue = []
+        for n, task in enumerate(tasks):
+            self.queue.append((persisted.get(self.task_key(task), now), n, task))
+        heapq.heapify(self.queue)
+
+        keys = set(self.task_key(t) for t in tasks)
+        with self.conn:
+            self.conn.executemany("DELETE FROM monitor_schedule WHERE origin = ? AND destination = ? "
+                                  "AND outbound_date = ? AND inbound_date = ?",
+                                  [k for k in persisted if k not in keys])
+
+    def next_refresh(self):
+        """
+        :return The time of the next due task, None if nothing is scheduled
+        """
+        return self.queue[0][0] if len(self.queue) > 0 else None
+
+    def pop_due(self, now, limit):
+        """
+        :param now - Current time
+        :param limit - Maximum number of tasks
+        :return List of the due tasks, removed from the queue
+        """
+        due = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now and len(due) < limit:
+            due.append(heapq.heappop(self.queue)[2])
+        return due
+
+    def volatility(self, task, n_observations=5):
+        """
+        :return Coefficient of variation of the last observed lowest prices
+        """
+        prices = [r[0] for r in
+                  self.conn.execute("SELECT MIN(price) FROM price_history "
+                                    "WHERE route = ? AND outbound_date = ? AND inbound_date = ? "
+                                    "GROUP BY observed_at ORDER BY observed_at DESC LIMIT ?",
+                                    ("%s-%s" % (task.dept_place, task.dest_place),
+                                     task.outbounddate, task.inbounddate, n_observations))]
+        if len(prices) < 2 or statistics.mean(prices) == 0:
+            return 0.0
+
+        return statistics.pstdev(prices) / statistics.mean(prices)
+
+    def refresh_interval(self, task, now):
+        """
+        The interval grows with the days to departure and shrinks with the
+        price volatility, bounded by the minimum and maximum intervals.
+        :param task - SearchTask
+        :param now - Current time
+        :return Refresh interval in seconds
+        """
+        outbound = datetime.strptime(task.outbounddate, "%Y-%m-%d")
+        days = max(0.0, (outbound - datetime.fromtimestamp(now)).total_seconds() / 86400.0)
+        interval = self.min_refresh_sec * (1.0 + days / 7.0) / (1.0 + 20.0 * self.volatility(task))
+        return min(self.max_refresh_sec, max(self.min_refresh_sec, interval))
+
+    def reschedule(self, task, now):
+        """
+        Schedule the next refresh of a task
+        :param task - SearchTask
+        :param now - Current time
+        """
+        next_refresh = now + self.refresh_interval(task, now)
+        heapq.heappush(self.queue, (next_refresh, id(task), task))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO monitor_schedule VALUES (?, ?, ?, ?, ?)",
+                              self.task_key(task) + (next_refresh,))
+
+
+def refresh(flight_search, db_client, scheduler, tasks):
+    """
+    Run the due queries, store their prices and schedule their next refresh
+    :param flight_search - FlightSearch object
+    :param db_client - SqliteClient object
+    :param scheduler - MonitorScheduler object
+    :param tasks - List of the due SearchTask
+    :return Number of queries completed
+    """
+    done = set()
+    for task, itineraries in flight_search.iter_results(tasks):
+        db_client.insert_prices(task, itineraries)
+        done.add(id(task))
+    db_client.flush()
+
+    now = time.time()
+    for task in tasks:
+        if id(task) in done:
+            scheduler.reschedule(task, now)
+        else:
+            # Retry a failed query after the minimum interval
+            heapq.heappush(scheduler.queue, (now + scheduler.min_refresh_sec, id(task), task))
+
+    return len(done)
+
+
+def run_monitor(flight):
+    """
+    Run the monitor until interrupted. The monitoring grid is rebuilt every
+    day so that it keeps starting from tomorrow.
+    :param flight - FlightQuery object
+    """
+    conf = flight.conf
+    flight.request_budget = RequestBudget(conf.get_api_requests_per_minute())
+    # A partial session or a cached result would be stored as the price
+    # observed now
+    flight.require_complete = True
+    flight.use_cache = False
+    flight_search = FlightSearch(flight)
+    db_client = SqliteClient(conf)
+    scheduler = MonitorScheduler(db_client.conn,
+                                 conf.get_monitor_min_refresh_sec(),
+                                 conf.get_monitor_max_refresh_sec())
+    grid_date = None
+
+    try:
+        while True:
+            today = datetime.now().date()
+            if grid_date != today:
+                db_client.flush()
+                start_date = datetime.combine(today, datetime.min.time()) + timedelta(days=1)
+                scheduler.load(build_monitor_grid(conf, flight.places, start_date))
+                grid_date = today
+                print_log("Monitor", "run_monitor", "Scheduled %d queries", len(scheduler.queue))
+
+            tasks = scheduler.pop_due(time.time(), flight_search.max_concurrent_queries)
+            if len(tasks) == 0:
+                next_refresh = scheduler.next_refresh()
+                time.sleep(60 if next_refresh is None else min(60, max(1, next_refresh - time.time())))
+                continue
+
+            done = refresh(flight_search, db_client, scheduler, tasks)
+            print_log("Monitor", "run_monitor", "Refreshed %d / %d queries", done, len(tasks))
+    finally:
+        db_client.close()
+
+
+def run_monitor_once(config_path):
+    """
+    Refresh the due queries once and exit, e.g. from cron. The API client is
+    only built when a city has to be looked up or a query is due, so a run
+    with nothing due only reads the sqlite file.
+    :param config_path - Configuration file path
+    """
+    conf = config.load(config_path)
+    clients = {}
+
+    def get_flight():
+        if 'flight' not in clients:
+            from query import FlightQuery
+            flight = FlightQuery(config_path)
+            flight.request_budget = RequestBudget(conf.get_api_requests_per_minute())
+            # A partial session or a cached result would be stored as the price
+            # observed now
+            flight.require_complete = True
+            flight.use_cache = False
+            clients['flight'] = flight
+        return clients['flight']
+
+    place_resolver = PlaceResolver(autosuggest=lambda keyword: get_flight().autosuggest(keyword),
+                                   sqlite_file_path=conf.get_sqlite_file_path(),
+                                   index_file_path=conf.get_place_index_file_path())
+    db_client = SqliteClient(conf)
+    try:
+        scheduler = MonitorScheduler(db_client.conn,
+                                     conf.get_monitor_min_refresh_sec(),
+                                     conf.get_monitor_max_refresh_sec())
+        today = datetime.combine(datetime.now().date(), datetime.min.time())
+        scheduler.load(build_monitor_grid(conf, place_resolver, today + timedelta(days=1)))
+        tasks = scheduler.pop_due(time.time(), len(scheduler.queue))
+        if len(tasks) == 0:
+            print_log("Monitor", "run_monitor_once", "No query is due")
+            return
+
+        done = refresh(FlightSearch(get_flight()), db_client, scheduler, tasks)
+        print_log("Monitor", "run_monitor_once", "Refreshed %d / %d queries", done, len(tasks))
+    finally:
+        db_client.close()
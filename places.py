@@ -0,0 +1,101 @@
+import csv
+import threading
+import time
+from db import connect_sqlite
+
+
+class PlaceResolver:
+    """
+    Resolves city names into Skyscanner place IDs. The resolved IDs are
+    memoized in memory and in the sqlite file, and can be preloaded from a
+    local place index file so that no autosuggest call is made at all.
+    """
+    def __init__(self, autosuggest, sqlite_file_path='', index_file_path=''):
+        """
+        :param autosuggest - Callable returning the top place ID of a keyword
+        :param sqlite_file_path - Sqlite file path, memory only if empty
+        :param index_file_path - Place index file path, see preload
+        """
+        self.autosuggest = autosuggest
+        self.places = {}
+        self.lock = threading.Lock()
+        self.conn = None
+        if sqlite_file_path:
+            self.conn = connect_sqlite(sqlite_file_path)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS places ("
+                              "keyword TEXT PRIMARY KEY, "
+                              "place_id TEXT, "
+                              "resolved_at REAL)")
+            self.conn.commit()
+            self.places.update(self.conn.execute("SELECT keyword, place_id FROM places"))
+
+        if index_file_path:
+            self.preload(index_file_path)
+
+    @staticmethod
+    def normalize(keyword):
+        """
+        :param keyword - City name
+        :return Normalized keyword
+        """
+        return " ".join(keyword.split()).casefold()
+
+    @staticmethod
+    def is_place_id(keyword):
+        """
+        :return True if the keyword is already a place ID, e.g. LOND-sky
+        """
+        return keyword.strip().endswith('-sky')
+
+    def preload(self, index_file_path):
+        """
+        Load the place index file. Each line is a city name and its place ID
+        separated by comma, e.g. "Hong Kong,HKGA-sky". Lines starting with #
+        are ignored.
+        :param index_file_path - Place index file path
+        """
+        with open(index_file_path, newline='') as f:
+            rows = [r for r in csv.reader(f) if len(r) >= 2 and not r[0].startswith('#')]
+
+        with self.lock:
+            for name, place_id in rows:
+                self.places[self.normalize(name)] = place_id.strip()
+
+    def resolve(self, keyword):
+        """
+        :param keyword - City name or place ID
+        :return The place ID, empty if it cannot be found
+        """
+        if self.is_place_id(keyword):
+            return keyword.strip()
+
+        key = self.normalize(keyword)
+        place_id = self.places.get(key)
+        if place_id is not None:
+            return place_id
+
+        # Another worker process may have resolved it since the startup
+        if self.conn is not None:
+            with self.lock:
+                row = self.conn.execute("SELECT place_id FROM places WHERE keyword = ?", (key,)).fetchone()
+            if row is not None:
+                self.places[key] = row[0]
+                return row[0]
+
+        place_id = self.autosuggest(keyword)
+        if place_id:
+            with self.lock:
+                self.places[key] = place_id
+                if self.conn is not None:
+                    self.conn.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?)",
+                                      (key, place_id, time.time()))
+                    self.conn.commit()
+
+        return place_id
+
+    def resolve_all(self, keywords):
+        """
+        :param keywords - List of city names
+        :return Dictionary of city name to place ID
+        """
+        return dict((k, self.resolve(k)) for k in keywords)
@@ -1,117 +1,35 @@
 import sys
-from skyscanner.skyscanner import Flights, FlightsCache, EmptyResponse
+from sys import intern
+from skyscanner.skyscanner import Flights, FlightsCache, EmptyResponse, GRACEFUL
 from datetime import datetime, timedelta
-import configparser
+import heapq
 import json
+import logging
+import threading
+import time
+import requests
+from collections.abc import Mapping
+from itertools import islice
+from operator import itemgetter
+from settings import config, print_log
+from cache import QueryCache, SingleFlight
+from places import PlaceResolver
+from transport import TransportMixin, create_transport
+from filters import ItineraryFilter
+from metrics import metrics
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
-def print_log(class_name, method_name, log_msg):
-    print("%s - [%s::%s] - %s" % (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
-                                  class_name,
-                                  method_name, 
-                                  log_msg))
-
-
-class config(configparser.ConfigParser):
-    """
-    Configuration object. 
-    """
-
-    def __init__(self, path):
-        """
-        :param path - Configuration file path
-        """
-        print_log(self.__class__.__name__,
-                  self.__init__.__name__,
-                  "Configuration path = %s" % path)
-        configparser.ConfigParser.__init__(self)
-        self.read(path)
-        print_log(self.__class__.__name__,
-                  self.__init__.__name__,
-                  "Configuration items:\n%s" % self.__dict__)
-
-    def get_api_key(self):
-        """
-        API key getter 
-        """            
-        return self.get('DEFAULT','API_KEY').strip()
-    
-    def get_market(self):
-        """
-        Market getter 
-        """
-        return self.get('DEFAULT','MARKET').strip()
-
-    def get_currency(self):
-        """
-        Currency getter 
-        """
-        return self.get('DEFAULT','CURRENCY').strip()
-
-    def get_locale(self):
-        """
-        Locale getter 
-        """
-        return self.get('DEFAULT','LOCALE').strip()
-
-    def get_adults(self):
-        """
-        Adults getter 
-        """
-        return self.get('DEFAULT','ADULTS').strip()
-
-    def get_query_init_delay_sec(self):
-        """
-        Query initial delay time in seconds
-        """
-        return int(self.get('DEFAULT','QUERY_INIT_DELAY_SEC').strip())
-
-    def get_query_delay_sec(self):
-        """
-        Query delay time in seconds
-        """
-        return int(self.get('DEFAULT','QUERY_DELAY_SEC').strip())
-    
-    def get_search_days(self):
-        """
-        Total number of days to search
-        """
-        return int(self.get('DEFAULT', 'SEARCH_DAYS').strip())
-        
-    def get_travel_interval_days(self):
-        """
-        Travel interval days. First value is the lower range while the second
-        is the higher
-        """
-        interval = self.get('DEFAULT', 'TRAVEL_INTERVAL_DAYS').split('-')
-        interval = [int(e.strip()) for e in interval]
-        return interval[0:2]
-    
-    def get_departure_cities(self):
-        """
-        List of departure cities
-        """
-        cities = self.get('DEFAULT', 'DEPARTURE_CITIES').split(',')
-        return [e.strip() for e in cities]
-        
-    def get_destination_cities(self):
-        """
-        List of destination cities
-        """
-        cities = self.get('DEFAULT', 'DESTINATION_CITIES').split(',')
-        return [e.strip() for e in cities]
-        
-    def get_sqlite_file_path(self):
-        """
-        List of destination cities
-        """
-        return self.get('DEFAULT', 'SQLITE_FILE_PATH').strip()
-        
-        
 class FlightAgent:
     """
     Agent
     """
+    __slots__ = ('Id', 'Name', 'OptimisedForMobile', 'Type')
+
     def __init__(self, agent_msg):
         """
         :param agent_msg - Message of an agent
@@ -119,13 +37,15 @@ class FlightAgent:
         self.Id = agent_msg['Id']
         self.Name = agent_msg['Name']
         self.OptimisedForMobile = agent_msg['OptimisedForMobile']
-        self.Type = agent_msg['Type']
+        self.Type = intern(agent_msg['Type'])
 
 
 class FlightCarrier:
     """
     Carrier
     """
+    __slots__ = ('Id', 'DisplayCode', 'Code', 'Name')
+
     def __init__(self, carrier_msg):
         """
         :param carrier_msg - Message of a carrier
@@ -140,20 +60,26 @@ class FlightPlace:
     """
     Place
     """
+    __slots__ = ('Id', 'Type', 'Code', 'Name')
+
     def __init__(self, place_msg):
         """
         :param place_msg: Message of a place
         """
         self.Id = place_msg['Id']
-        self.Type = place_msg['Type']
+        self.Type = intern(place_msg['Type'])
         self.Code = place_msg['Code']
         self.Name = place_msg['Name']
 
 
 class FlightItineraryLeg:
     """
-    Itinerary leg
+    Itinerary leg. The timestamps and directionality repeat across the legs
+    of a response, so they are interned.
     """
+    __slots__ = ('Id', 'OriginStation', 'DestinationStation', 'Departure',
+                 'Arrival', 'Carriers', 'Stops', 'Directionality')
+
     def __init__(self, leg_msg):
         """
         :param leg_msg - Message of an itinerary leg
@@ -161,26 +87,87 @@ class FlightItineraryLeg:
         self.Id = leg_msg['Id']
         self.OriginStation = leg_msg['OriginStation']
         self.DestinationStation = leg_msg['DestinationStation']
-        self.Departure = leg_msg['Departure']
-        self.Arrival = leg_msg['Arrival']
-        self.Carriers = leg_msg['Carriers']
-        self.Directionality = leg_msg['Directionality']
+        self.Departure = intern(leg_msg['Departure'])
+        self.Arrival = intern(leg_msg['Arrival'])
+        self.Carriers = tuple(leg_msg['Carriers'])
+        self.Stops = tuple(leg_msg.get('Stops', ()))
+        self.Directionality = intern(leg_msg['Directionality'])
+
+    def to_dict(self):
+        """
+        :return The leg attributes in a dictionary
+        """
+        return dict((k, getattr(self, k)) for k in FlightItineraryLeg.__slots__)
+
+
+class LazyTable(Mapping):
+    """
+    Dictionary of the messages keyed by ID, which are parsed into objects on
+    first access.
+    """
+    def __init__(self, messages, parse):
+        """
+        :param messages - List of messages with an Id field
+        :param parse - Callable parsing a message into an object
+        """
+        self.messages = dict((m['Id'], m) for m in messages)
+        self.parse = parse
+        self.parsed = {}
+        # Field names of the messages slimmed into tuples
+        self.fields = None
+
+    def __getitem__(self, key):
+        obj = self.parsed.get(key)
+        if obj is None:
+            msg = self.messages[key]
+            if self.fields is not None:
+                msg = dict((f, v) for f, v in zip(self.fields, msg) if v is not None)
+            obj = self.parse(msg)
+            self.parsed[key] = obj
+        return obj
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def slim(self, fields):
+        """
+        Keep only the fields of the messages which the parser reads, as
+        tuples, without parsing them
+        :param fields - Names of the fields read by the parser
+        """
+        if self.fields is not None:
+            return
+
+        get = itemgetter(*fields)
+        for key, msg in self.messages.items():
+            try:
+                self.messages[key] = get(msg)
+            except KeyError:
+                self.messages[key] = tuple(msg.get(f) for f in fields)
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.messages)
 
 
 class FlightItinerary:
     """
     Flight itinerary. 
     """
+    __slots__ = ('OutboundLegId', 'InboundLegId', 'PricingOptions', 'LowestPrice')
+
     class FlightPricingOption:
         """
         Pricing option
         """
+        __slots__ = ('Price', 'Agents', 'QuoteAgeInMinutes')
+
         def __init__(self, price_msg):
             """
             :param price_msg - Message of a pricing option
             """
             self.Price = float(price_msg['Price'])
-            self.Agents = price_msg['Agents']
+            self.Agents = tuple(price_msg['Agents'])
             self.QuoteAgeInMinutes = price_msg['QuoteAgeInMinutes']
 
     def __init__(self, msg):
@@ -188,34 +175,58 @@ class FlightItinerary:
         :param msg - Message of an itinerary
         """
         self.OutboundLegId = msg['OutboundLegId']
-        self.InboundLegId = msg['InboundLegId']
-        self.PricingOptions = [FlightItinerary.FlightPricingOption(p) for p in msg['PricingOptions']]
-                 
+        # One way itineraries have no inbound leg
+        self.InboundLegId = msg.get('InboundLegId')
+        self.PricingOptions = tuple(FlightItinerary.FlightPricingOption(p) for p in msg['PricingOptions'])
+        self.LowestPrice = min([int(p.Price) for p in self.PricingOptions], default=None)
+
     def get_lowest_price(self):
         """
-        :return The lowest price among the pricing option
+        :return The lowest price among the pricing option, None if there is
+                no pricing option
         """
-        return min([int(p.Price) for p in self.PricingOptions])
+        return self.LowestPrice
+
+    @staticmethod
+    def from_legs(outbound_leg_id, inbound_leg_id, lowest_price):
+        """
+        Itinerary of a compacted result, without the pricing options
+        :param outbound_leg_id - Outbound leg ID
+        :param inbound_leg_id - Inbound leg ID, None if one way
+        :param lowest_price - Lowest price
+        :return FlightItinerary
+        """
+        itinerary = FlightItinerary.__new__(FlightItinerary)
+        itinerary.OutboundLegId = outbound_leg_id
+        itinerary.InboundLegId = inbound_leg_id
+        itinerary.PricingOptions = ()
+        itinerary.LowestPrice = lowest_price
+        return itinerary
 
         
-class FlightQuery(Flights):
+class FlightQuery(TransportMixin, Flights):
     class FlightQueryResult:
         """
         Flight query result
         """
-        def __init__(self, ret):
+        def __init__(self, ret, lazy=False):
             """
             :param ret - Parsed query result
+            :param lazy - If True, only the lowest price of each itinerary is
+                          computed up front. The itineraries, legs, agents,
+                          carriers and places are parsed on first access.
             """
-            self.Itineraries = []
             self.Legs = {}
             self.Agents = {}
             self.Carriers = {}
             self.Places = {}
+            # False if the session was still pending when the poll returned,
+            # also when it is loaded from the sqlite cache
+            self.complete = ret.get('Status', 'UpdatesComplete') == 'UpdatesComplete'
 
             try:
                 query = ret['Query']
-                self.InboundDate = query['InboundDate']
+                self.InboundDate = query.get('InboundDate')
                 self.DestinationPlace = query['DestinationPlace']
                 self.CabinClass = query['CabinClass']
                 self.Adults = query['Adults']
@@ -226,11 +237,24 @@ class FlightQuery(Flights):
                 self.OriginPlace = query['OriginPlace']
                 self.GroupPricing = query['GroupPricing']
             except TypeError as nt:
-                print_log(self.__class__.__name__, 
+                print_log(self.__class__.__name__,
                           self.__init__.__name__,
-                          "%s\n%s" % (nt, ret))
+                          "%s\n%s", nt, ret,
+                          level=logging.ERROR)
                 raise nt
             
+            if lazy:
+                self.Legs = LazyTable(ret['Legs'], FlightItineraryLeg)
+                self.Agents = LazyTable(ret['Agents'], FlightAgent)
+                self.Carriers = LazyTable(ret['Carriers'], FlightCarrier)
+                self.Places = LazyTable(ret['Places'], FlightPlace)
+                self.itinerary_msgs = ret['Itineraries']
+                self.itinerary_legs = None
+                self.itineraries = [None] * len(self.itinerary_msgs)
+                self.lowest_prices = [min([int(float(p['Price'])) for p in i['PricingOptions']], default=None)
+                                      for i in self.itinerary_msgs]
+                return
+
             for leg in ret['Legs']:
                 self.Legs[leg['Id']] = FlightItineraryLeg(leg)
             
@@ -243,8 +267,48 @@ class FlightQuery(Flights):
             for place in ret['Places']:
                 self.Places[place['Id']] = FlightPlace(place)
 
-            for itinerary in ret['Itineraries']:
-                self.Itineraries.append(FlightItinerary(itinerary))
+            self.itinerary_msgs = None
+            self.itinerary_legs = None
+            self.itineraries = [FlightItinerary(i) for i in ret['Itineraries']]
+            self.lowest_prices = [i.LowestPrice for i in self.itineraries]
+
+        @property
+        def Itineraries(self):
+            """
+            :return List of all the itineraries
+            """
+            return [self.get_itinerary(n) for n in range(len(self.itineraries))]
+
+        def get_itinerary(self, n):
+            """
+            :param n - Index of the itinerary
+            :return The n-th itinerary
+            """
+            itinerary = self.itineraries[n]
+            if itinerary is None:
+                if self.itinerary_msgs is not None:
+                    itinerary = FlightItinerary(self.itinerary_msgs[n])
+                else:
+                    itinerary = FlightItinerary.from_legs(*self.itinerary_legs[n], self.lowest_prices[n])
+                self.itineraries[n] = itinerary
+            return itinerary
+
+        def compact(self):
+            """
+            Drop the itinerary messages kept by a lazy result, e.g. before it
+            is cached, as their pricing options and booking details are most
+            of the response. The unparsed itineraries are kept as their leg
+            IDs and lowest prices only. The legs stay lazy, but their
+            messages keep only the fields parsed, e.g. not the segments and
+            flight numbers, so nothing more is parsed.
+            """
+            if self.itinerary_msgs is None:
+                return
+
+            self.itinerary_legs = [None if parsed is not None else (msg['OutboundLegId'], msg.get('InboundLegId'))
+                                   for parsed, msg in zip(self.itineraries, self.itinerary_msgs)]
+            self.itinerary_msgs = None
+            self.Legs.slim(FlightItineraryLeg.__slots__)
 
         def get_itinerary_leg(self, leg_id):
             """
@@ -252,21 +316,38 @@ class FlightQuery(Flights):
             """            
             return self.Legs[leg_id]
         
-        def get_lowest_price(self, n_itinerary=3, filter=None):
+        def get_lowest_price(self, n_itinerary=3, filter=None, itinerary_filter=None):
             """
             :param n_itinerary - The number of lowest price itineraries
-            :return The first n-th lowest price itineraries
+            :param filter - Filter on the readable itinerary dictionary
+            :param itinerary_filter - Filter called with the query result and
+                                      the FlightItinerary, before any
+                                      dictionary is built
+            :return The first n-th lowest price itineraries, sorted by price
             """
+            # The itineraries are popped in price order and the filters are
+            # applied lazily, so only the itineraries up to the n-th accepted
+            # one are parsed and converted
+            start = time.perf_counter()
+            filter_sec = 0.0
+            heap = [(p, n) for n, p in enumerate(self.lowest_prices) if p is not None]
+            heapq.heapify(heap)
             lowest = []
-            for itinerary in self.Itineraries:
-                i_dict = self.to_dict(itinerary)
+            while len(heap) > 0 and len(lowest) < n_itinerary:
+                itinerary = self.get_itinerary(heapq.heappop(heap)[1])
+                if itinerary_filter is not None:
+                    filter_start = time.perf_counter()
+                    accepted = itinerary_filter(self, itinerary)
+                    filter_sec += time.perf_counter() - filter_start
+                    if not accepted:
+                        continue
 
+                i_dict = self.to_dict(itinerary)
                 if filter is None or filter(i_dict):
                     lowest.append(i_dict)
-                    if len(lowest) > n_itinerary:
-                        lowest.sort(key=lambda x: x['Price'])
-                        del lowest[-1]
 
+            metrics.observe('filter', filter_sec)
+            metrics.observe('rank', time.perf_counter() - start - filter_sec)
             return lowest
 
         def to_dict(self, itinerary):
@@ -275,20 +356,54 @@ class FlightQuery(Flights):
             :return Converted to a readable dictionary
             """
             ret = dict()
-            outbound = dict(self.Legs[itinerary.OutboundLegId].__dict__)
-            inbound = dict(self.Legs[itinerary.InboundLegId].__dict__)
-            outbound['Carriers'] = [self.Carriers[e].Name for e in outbound['Carriers']]
-            inbound['Carriers'] = [self.Carriers[e].Name for e in inbound['Carriers']]
-            outbound['DestinationStation'] = self.Places[outbound['DestinationStation']].Name
-            outbound['OriginStation'] = self.Places[outbound['OriginStation']].Name
-            inbound['DestinationStation'] = self.Places[inbound['DestinationStation']].Name
-            inbound['OriginStation'] = self.Places[inbound['OriginStation']].Name
-            ret['OutboundLeg'] = outbound
-            ret['InboundLeg'] = inbound
+            ret['OutboundLeg'] = self.leg_to_dict(itinerary.OutboundLegId)
+            ret['InboundLeg'] = None if itinerary.InboundLegId is None \
+                else self.leg_to_dict(itinerary.InboundLegId)
             ret['Price'] = itinerary.get_lowest_price()
 
             return ret
 
+        def leg_to_dict(self, leg_id):
+            """
+            :param leg_id: The itinerary leg ID
+            :return The leg converted to a readable dictionary
+            """
+            leg = self.Legs[leg_id].to_dict()
+            leg['Carriers'] = [self.Carriers[e].Name for e in leg['Carriers']]
+            leg['DestinationStation'] = self.Places[leg['DestinationStation']].Name
+            leg['OriginStation'] = self.Places[leg['OriginStation']].Name
+            leg['Stops'] = [self.Places[e].Name for e in leg['Stops'] if e in self.Places]
+            return leg
+
+        @staticmethod
+        def merge_ranked(ranked, n_itinerary=None):
+            """
+            :param ranked - Lists of readable itineraries, each sorted by price
+            :param n_itinerary - The number of lowest price itineraries, all
+                                 if None
+            :return The merged itineraries sorted by price
+            """
+            merged = heapq.merge(*ranked, key=lambda x: x['Price'])
+            return list(islice(merged, n_itinerary))
+
+        @staticmethod
+        def merge_lowest_price(results, n_itinerary=3, n_total=None, filter=None,
+                               itinerary_filter=None):
+            """
+            :param results - List of FlightQueryResult
+            :param n_itinerary - The number of lowest price itineraries per result
+            :param n_total - The number of lowest price itineraries overall, all
+                             if None
+            :param filter - Filter on the readable itinerary dictionary
+            :param itinerary_filter - Filter on the FlightItinerary
+            :return The lowest price itineraries across the results
+            """
+            return FlightQuery.FlightQueryResult.merge_ranked(
+                [r.get_lowest_price(n_itinerary=n_itinerary,
+                                    filter=filter,
+                                    itinerary_filter=itinerary_filter) for r in results],
+                n_total)
+
         @staticmethod
         def to_json(itinerary):
             """
@@ -297,87 +412,284 @@ class FlightQuery(Flights):
             """
             return json.dumps(itinerary, default=lambda o: o.__dict__, indent=4)
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, transport=None):
         """
         :param config_path - Configuration file path
+        :param transport - HTTP transport, created from the configuration if None
         """
-        self.conf = config(config_path)
+        self.conf = config.load(config_path)
+        self.transport = transport or create_transport(self.conf)
+        self.api_host = self.conf.get_api_host()
         self.market = self.conf.get_market()
         self.currency = self.conf.get_currency()
         self.locale = self.conf.get_locale()
         self.adults = self.conf.get_adults()
         self.query_init_delay_sec = self.conf.get_query_init_delay_sec()
         self.query_delay_sec = self.conf.get_query_delay_sec()
+        self.poll_min_delay_sec = self.conf.get_poll_min_delay_sec()
+        self.poll_deadline_sec = self.conf.get_poll_deadline_sec()
+        self.poll_stable_polls = self.conf.get_poll_stable_polls()
+        self.poll_stable_top_n = self.conf.get_poll_stable_top_n()
+        self.lazy_parsing = self.conf.get_lazy_parsing()
+        # If True, a session still pending at the poll deadline fails its
+        # query instead of returning the itineraries so far
+        self.require_complete = False
+        # If False, every query is priced live, e.g. for the monitor which
+        # stores the prices as observed now. The results are still cached.
+        self.use_cache = True
+        self.deadlines = threading.local()
+        self.cache = QueryCache(parse=self.parse_result,
+                                sqlite_file_path=self.conf.get_sqlite_file_path(),
+                                ttl_sec=self.conf.get_cache_ttl_sec(),
+                                route_ttl_sec=self.conf.get_cache_route_ttl_sec(),
+                                max_entries=self.conf.get_cache_max_entries(),
+                                max_db_entries=self.conf.get_cache_max_db_entries(),
+                                partial_ttl_sec=self.conf.get_cache_partial_ttl_sec())
+        self.inflight = SingleFlight()
+        self.places = PlaceResolver(autosuggest=self.autosuggest,
+                                    sqlite_file_path=self.conf.get_sqlite_file_path(),
+                                    index_file_path=self.conf.get_place_index_file_path())
         Flights.__init__(self, self.conf.get_api_key())
-        
-    def top_autosuggest(self, keyword):
+
+    def get_deadline(self):
         """
-        Get the top auto suggestion on location
+        :return The poll deadline of the live pricing query of this thread
+        """
+        return getattr(self.deadlines, 'deadline', None)
+
+    @staticmethod
+    def _parse_resp(resp, response_format):
+        """
+        Parse the response with the fastest json decoder available
+        """
+        if response_format == 'json':
+            resp.parsed = json_loads(resp.content)
+            return resp
+        return Flights._parse_resp(resp, response_format)
+
+    def parse_result(self, content):
+        """
+        :param content - Query result in json
+        :return FlightQueryResult
+        """
+        with metrics.timed('parse'):
+            query_result = FlightQuery.FlightQueryResult(json_loads(content), lazy=self.lazy_parsing)
+            query_result.compact()
+        return query_result
+
+    def autosuggest(self, keyword):
+        """
+        Query the top auto suggestion on location from the API
         :param keyword - Keyword to search for location auto suggestion
-        """        
-        ret = self.location_autosuggest(query=keyword,
-                                      market=self.market,
-                                      currency=self.currency,
-                                      locale=self.locale).parsed
+        :return The place ID, empty if nothing is suggested
+        """
+        with metrics.timed('autosuggest'):
+            ret = self.location_autosuggest(query=keyword,
+                                            market=self.market,
+                                            currency=self.currency,
+                                            locale=self.locale).parsed
+
+        if len(ret['Places']) == 0:
+            return ""
 
         return ret['Places'][0]['PlaceId']
 
-    def Query(self, dept_place, dest_place, outbounddate, inbounddate):
+    def top_autosuggest(self, keyword):
+        """
+        Get the top auto suggestion on location
+        :param keyword - Keyword to search for location auto suggestion
+        """
+        return self.places.resolve(keyword)
+
+    def Query(self, dept_place, dest_place, outbounddate, inbounddate=None):
         """
         Query all the flight prices based on human readable departure and
         destination places.
         :param dept_place - Departure location
         :param dest_place - Destination location
         :param outbounddate - Outbound date
-        :param inbounddate - Inbound date
+        :param inbounddate - Inbound date, one way if None
         :return All the itineraries
         """
-        ret = self.get_result(
-                country=self.market,
-                currency=self.currency,
-                locale=self.locale,
-                originplace=dept_place,
-                destinationplace=dest_place,
-                outbounddate=outbounddate,
-                inbounddate=inbounddate,
-                adults=self.adults,
-                initial_delay=self.query_init_delay_sec, # Useless in current API
-                delay=self.query_delay_sec # Useless in current API
-                ).parsed
-                   
-        query_result = FlightQuery.FlightQueryResult(ret)    
-            
+        key = QueryCache.make_key(dept_place, dest_place, outbounddate, inbounddate,
+                                  self.adults, self.market, self.currency)
+        if self.use_cache:
+            query_result = self.cache.get(key)
+            if query_result is not None:
+                return query_result
+
+        # Concurrent identical queries share one live pricing session
+        return self.inflight.do(key, lambda: self.query_live(key, dept_place, dest_place,
+                                                              outbounddate, inbounddate))
+
+    def query_live(self, key, dept_place, dest_place, outbounddate, inbounddate):
+        """
+        Query the flight prices from a live pricing session and cache them. A
+        session returned early has a part of the itineraries, so it is
+        cached for CACHE_PARTIAL_TTL_SEC at most.
+        :param key - Cache key
+        :param dept_place - Departure location
+        :param dest_place - Destination location
+        :param outbounddate - Outbound date
+        :param inbounddate - Inbound date, one way if None
+        :return FlightQueryResult
+        """
+        params = dict(country=self.market,
+                      currency=self.currency,
+                      locale=self.locale,
+                      originplace=dept_place,
+                      destinationplace=dest_place,
+                      outbounddate=outbounddate,
+                      adults=self.adults)
+        if inbounddate is not None:
+            params['inbounddate'] = inbounddate
+        # The deadline bounds the session creation, the polls and their retries
+        self.deadlines.deadline = time.monotonic() + self.poll_deadline_sec
+        try:
+            with metrics.timed('session'):
+                poll_url = self.create_session(**params)
+            with metrics.timed('poll'):
+                resp, complete = self.poll_adaptive(poll_url)
+        finally:
+            self.deadlines.deadline = None
+
+        if not complete and self.require_complete:
+            raise RuntimeError("Session %s-%s@%s/%s is not complete by the deadline" %
+                               (dept_place, dest_place, outbounddate, inbounddate))
+
+        ret = resp.parsed
+        with metrics.timed('parse'):
+            query_result = FlightQuery.FlightQueryResult(ret, lazy=self.lazy_parsing)
+            # The cached result keeps only what ranking needs
+            query_result.compact()
+        query_result.complete = complete
+        self.cache.put(key, dept_place, dest_place, ret, query_result, complete=complete)
+
         return query_result
 
 
-class FlightCacheQuery(FlightsCache):
+    @staticmethod
+    def cheapest_signature(parsed, top_n):
+        """
+        :param parsed - Parsed poll response
+        :param top_n - Number of cheapest itineraries
+        :return Tuple of the lowest price and the legs of the cheapest
+                itineraries, to tell whether they changed between polls
+        """
+        if not isinstance(parsed, dict):
+            return ()
+        prices = ((min([float(p['Price']) for p in i['PricingOptions']], default=None),
+                   i['OutboundLegId'], i.get('InboundLegId'))
+                  for i in parsed.get('Itineraries', []))
+        return tuple(heapq.nsmallest(top_n, (p for p in prices if p[0] is not None)))
+
+    def poll_adaptive(self, poll_url):
+        """
+        Poll the session until it is complete, its cheapest itineraries stay
+        the same over a number of consecutive polls, or the deadline. The
+        interval starts at the minimum and doubles up to QUERY_DELAY_SEC, as
+        most agents reply early and the stragglers reply late. A poll failing
+        gracefully, e.g. on 429, is retried on the next interval.
+        :param poll_url - Poll URL of the session
+        :return Tuple of the last successful poll response and whether the
+                session is complete
+        """
+        deadline = self.get_deadline() or time.monotonic() + self.poll_deadline_sec
+        time.sleep(max(0.0, min(self.query_init_delay_sec, deadline - time.monotonic())))
+        delay = self.poll_min_delay_sec
+        signature = None
+        last = None
+        complete = False
+        n_stable = 0
+        n_polls = 0
+        while True:
+            try:
+                resp = self.make_request(poll_url, headers=self._headers(), errors=GRACEFUL)
+            except requests.Timeout:
+                # The deadline expired during the poll
+                if last is None:
+                    raise
+                metrics.incr('poll_deadline_returns')
+                break
+            n_polls += 1
+
+            parsed = resp.parsed
+            if isinstance(parsed, dict) and 'Itineraries' in parsed:
+                last = resp
+                if self.is_poll_complete(resp):
+                    complete = True
+                    break
+
+                current = self.cheapest_signature(parsed, self.poll_stable_top_n)
+                n_stable = n_stable + 1 if len(current) > 0 and current == signature else 0
+                signature = current
+                if 0 < self.poll_stable_polls <= n_stable and not self.require_complete:
+                    metrics.incr('poll_stable_returns')
+                    break
+
+            # No time left for another poll after the interval
+            remaining = deadline - time.monotonic()
+            if remaining <= delay:
+                if last is None:
+                    raise RuntimeError("No poll response of %s before the deadline" % poll_url)
+                metrics.incr('poll_deadline_returns')
+                break
+
+            time.sleep(delay)
+            delay = min(delay * 2, max(self.query_delay_sec, self.poll_min_delay_sec))
+
+        metrics.incr('polls', n_polls)
+        return last, complete
+
+
+class FlightCacheQuery(TransportMixin, FlightsCache):
     class Types:
         CHEAPEST_QUOTES = 0,
         CHEAPEST_PRICE_BY_DATE = 1,
         GRID_PRICES_BY_DATE = 2
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, transport=None):
         """
         Constructor
         :param config_path: Configuration file path
+        :param transport: HTTP transport, created from the configuration if None
         """
-        self.conf = config(config_path)
+        self.conf = config.load(config_path)
+        self.transport = transport or create_transport(self.conf)
+        self.api_host = self.conf.get_api_host()
         self.market = self.conf.get_market()
         self.currency = self.conf.get_currency()
         self.locale = self.conf.get_locale()
         self.query_init_delay_sec = self.conf.get_query_init_delay_sec()
         self.query_delay_sec = self.conf.get_query_delay_sec()
+        self.places = PlaceResolver(autosuggest=self.autosuggest,
+                                    sqlite_file_path=self.conf.get_sqlite_file_path(),
+                                    index_file_path=self.conf.get_place_index_file_path())
         FlightsCache.__init__(self, self.conf.get_api_key())
 
+    def autosuggest(self, keyword):
+        """
+        Query the top auto suggestion on location from the API
+        :param keyword - Keyword to search for location auto suggestion
+        :return The place ID, empty if nothing is suggested
+        """
+        with metrics.timed('autosuggest'):
+            ret = self.location_autosuggest(query=keyword,
+                                            market=self.market,
+                                            currency=self.currency,
+                                            locale=self.locale).parsed
+
+        if len(ret['Places']) == 0:
+            return ""
+
+        return ret['Places'][0]['PlaceId']
+
     def top_autosuggest(self, keyword):
         """
         Get the top auto suggestion on location
         :param keyword - Keyword to search for location auto suggestion
         """
-        ret = self.location_autosuggest(query=keyword,
-                                        market=self.market,
-                                        currency=self.currency,
-                                        locale=self.locale).parsed
+        return self.places.resolve(keyword)
 
     def Query(self, dept_place, dest_place, outbounddate, inbounddate, type=Types.CHEAPEST_PRICE_BY_DATE):
         """
@@ -387,7 +699,17 @@ class FlightCacheQuery(FlightsCache):
         :param dest_place - Destination location
         :param outbounddate - Outbound date
         :param inbounddate - Inbound date
-        :return All the itineraries
+        :param type - Type of the browse cache query
+        :return The parsed response
+        """
+        with metrics.timed('browse'):
+            ret = self.query_browse(dept_place, dest_place, outbounddate, inbounddate, type)
+        return ret.parsed
+
+    def query_browse(self, dept_place, dest_place, outbounddate, inbounddate, type):
+        """
+        Query the browse cache endpoint of the type
+        :return The response
         """
         if type == FlightCacheQuery.Types.CHEAPEST_QUOTES:
             ret = self.get_cheapest_quotes(market=self.market,
@@ -413,15 +735,26 @@ class FlightCacheQuery(FlightsCache):
                                                destinationplace=dest_place,
                                                outbounddate=outbounddate,
                                                inbounddate=inbounddate)
-        print(json.dumps(ret.parsed, indent=4))
+        return ret
 
+    def get_browse_prices(self, dept_place, dest_place, outbounddate, inbounddate):
+        """
+        Get the cached lowest prices of the round trips
+        :param dept_place - Departure place ID
+        :param dest_place - Destination place ID
+        :param outbounddate - Outbound date or month, e.g. 2017-03
+        :param inbounddate - Inbound date or month
+        :return Dictionary of (outbound date, inbound date) to the lowest price
+        """
+        ret = self.Query(dept_place, dest_place, outbounddate, inbounddate)
+        prices = {}
+        for quote in ret.get('Quotes', []):
+            if 'InboundLeg' not in quote:
+                continue
+            key = (quote['OutboundLeg']['DepartureDate'][:10], quote['InboundLeg']['DepartureDate'][:10])
+            prices[key] = min(prices.get(key, quote['MinPrice']), quote['MinPrice'])
 
-def test_carrier_filter(itinerary):
-    out_carriers = itinerary['OutboundLeg']['Carriers']
-    in_carriers = itinerary['InboundLeg']['Carriers']
-
-    return all([c.find('China') == -1 for c in out_carriers]) and \
-        all([c.find('China') == -1 for c in in_carriers])
+        return prices
 
 
 def test_flight_query():
@@ -441,17 +774,15 @@ def test_flight_query():
                               dest_place=dest,
                               outbounddate=start.strftime("%Y-%m-%d"),
                               inbounddate=end.strftime("%Y-%m-%d"))
-        lowest += result.get_lowest_price(filter=test_carrier_filter)
+        lowest.append(result.get_lowest_price(itinerary_filter=ItineraryFilter('-China')))
 
         if 1.0*i/total > prev_progress:
             print_log('[Default]',
                       'main',
-                      "Progress {0:.0f}%".format(prev_progress))
+                      "Progress %.0f%%", prev_progress)
             prev_progress += 0.1
 
-    lowest.sort(key=lambda x: x['Price'])
-
-    for l in lowest:
+    for l in FlightQuery.FlightQueryResult.merge_ranked(lowest):
         print("================================")
         print(FlightQuery.FlightQueryResult.to_json(l))
 
@@ -1,55 +1,136 @@
 import os, sys
-from flask import Flask, Blueprint, render_template, request
+import json
+import logging
+import queue
+from flask import Flask, Blueprint, Response, current_app, jsonify, render_template, request, \
+    stream_with_context, url_for
 from datetime import datetime, timedelta
-from query import FlightQuery, print_log
-from functools import partial
-
-
-def carrier_filtering(itinerary, welcome_carriers, unwelcome_carriers):
-    """
-    Filter the carriers.
-    :param itinerary:
-    :param welcome_carriers: List of welcoming carriers
-    :param unwelcome_carriers: List of unwelcoming carriers
-    :return: True if it passes the filtering
-    """
-    out_carriers = itinerary['OutboundLeg']['Carriers']
-    in_carriers = itinerary['InboundLeg']['Carriers']
-
-    if len(welcome_carriers) > 0:
-        ret = False
-        for carrier in welcome_carriers:
-            ret |= any([c.find(carrier) > -1 for c in out_carriers]) or \
-                   any([c.find(carrier) > -1 for c in in_carriers])
-
-        return ret
-    elif len(unwelcome_carriers) > 0:
-        ret = True
-        for carrier in unwelcome_carriers:
-            ret &= all([c.find(carrier) == -1 for c in out_carriers]) and \
-                   all([c.find(carrier) == -1 for c in in_carriers])
-        return ret
-    else:
-        return True
+from query import FlightQuery, FlightCacheQuery
+from settings import print_log
+from metrics import metrics
+from search import FlightSearch
+from filters import ItineraryFilter
+from jobs import JobManager
+from export import HISTORY_COLUMNS, ITINERARY_COLUMNS, MIME_TYPES, chunked, history_chunks, \
+    itinerary_rows, iter_export, get_formats
+
 
 ##########################################################################################
 
-app = Flask(__name__)
 webapp = Blueprint(__name__, __name__, static_folder='static')
-enable_ssl = False
-
-if len(sys.argv) < 2 or len(sys.argv) > 3:
-    print("Usage: python run.py <config_file> (--ssl)")
-    sys.exit(0)
-elif len(sys.argv) == 3:
-    if sys.argv[2] == "--ssl":
-        enable_ssl = True
-    else:
-        print("Usage: python run.py <config_file> (--ssl)")
-        sys.exit(0)
 
-config_file_path = sys.argv[1]
-flight = FlightQuery(config_file_path)
+
+class Dashboard:
+    """
+    The query clients and the search jobs of an app
+    """
+    def __init__(self, config_path):
+        """
+        :param config_path: Configuration file path
+        """
+        self.flight = FlightQuery(config_path)
+        self.flight_search = FlightSearch(self.flight, cache_flight=FlightCacheQuery(config_path))
+        conf = self.flight.conf
+        self.jobs = JobManager(self.flight_search,
+                               max_workers=conf.get_job_workers(),
+                               max_queued=conf.get_job_queue_size(),
+                               result_ttl_sec=conf.get_job_result_ttl_sec(),
+                               sqlite_file_path=conf.get_sqlite_file_path())
+        self.analytics = None
+        if conf.get_sqlite_file_path():
+            # numpy is only loaded with a price history
+            from analytics import PriceAnalytics
+            self.analytics = PriceAnalytics(conf.get_sqlite_file_path())
+
+    def warm_up(self):
+        """
+        Resolve the configured cities and load the recent query results of
+        the shared sqlite cache, so that a new or restarted worker does not
+        start cold
+        """
+        cities = self.flight.conf.get_warm_up_cities()
+        try:
+            places = self.flight.places.resolve_all(cities)
+        except Exception as ex:
+            places = {}
+            print_log(self.__class__.__name__, self.warm_up.__name__,
+                      "Failed to resolve the cities: %s", ex, level=logging.WARNING)
+
+        print_log(self.__class__.__name__, self.warm_up.__name__,
+                  "Resolved %d / %d cities and loaded %d cached results",
+                  len([p for p in places.values() if p]), len(cities), self.flight.cache.warm())
+
+    @staticmethod
+    def check_search(form):
+        """
+        Reject the search conditions which cannot be combined. A flexible
+        date search is branch and bound over round trips, already pricing
+        the cached date pairs first, so it takes neither return cities nor
+        the two tier search.
+        :param form: Request form or arguments
+        :raise ValueError: If the conditions cannot be combined
+        """
+        interval = [e.strip() for e in form.get('interval', '').split('-')][0:2]
+        if len(interval) == 2 and interval[0] != interval[1]:
+            if form.get('return-city', '').strip():
+                raise ValueError("Return cities are not supported with a range of days")
+            if form.get('two-tier'):
+                raise ValueError("Cached prices first is not supported with a range of days")
+
+    def parse_search(self, form):
+        """
+        Parse the search conditions
+        :param form: Request form or arguments
+        :return: Dictionary of the search tasks and the carrier filter
+        """
+        self.check_search(form)
+        depts = [d.strip() for d in form['dept-city'].split(',')]
+        dests = [d.strip() for d in form['dest-city'].split(',')]
+        returns = [d.strip() for d in form.get('return-city', '').split(',') if d.strip()]
+        dept_date = form['dept-date']
+        dest_date = form['dest-date']
+        # A range of days, e.g. 7-10, searches the dates flexibly
+        interval = [int(e.strip()) for e in form['interval'].split('-')][0:2]
+        itinerary_filter = ItineraryFilter(carrier_filter=form['carrier_filter'],
+                                           max_stops=int(form['max-stops']) if form.get('max-stops') else None,
+                                           depart_after=form.get('depart-after') or None,
+                                           depart_before=form.get('depart-before') or None,
+                                           max_price=float(form['max-price']) if form.get('max-price') else None)
+        start_date = datetime.strptime(dept_date, "%Y-%m-%d")
+        end_date = datetime.strptime(dest_date, "%Y-%m-%d")
+        if len(interval) == 2 and interval[0] != interval[1]:
+            tasks = self.flight_search.build_flexible_grid(depts, dests, start_date, end_date, *interval)
+            return {'tasks': tasks, 'itinerary_filter': itinerary_filter}
+
+        interval = interval[0]
+        date_diff = (end_date - start_date).days - interval + 1
+        print_log("Webapp", "parse_search", "Date diff = %d", date_diff)
+        if len(returns) > 0:
+            # Open jaw trips, priced from the shared one way legs
+            tasks = self.flight_search.build_open_jaw_grid(depts, dests, returns, start_date, date_diff, interval)
+        else:
+            tasks = self.flight_search.build_grid(depts, dests, start_date, date_diff, interval)
+            if form.get('two-tier'):
+                tasks = self.flight_search.shortlist(tasks)
+
+        return {'tasks': tasks, 'itinerary_filter': itinerary_filter}
+
+
+def get_dashboard():
+    """
+    :return: Dashboard of the current app
+    """
+    return current_app.extensions['dashboard']
+
+
+def sse_event(event, data):
+    """
+    Format a server-sent event
+    :param event: Event name
+    :param data: Event data, serialized in json
+    :return: The event message
+    """
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
 
 
 @webapp.route('/', methods=['GET', 'POST'])
@@ -58,55 +139,331 @@ def index():
     Index page callback
     :return: Index page
     """
+    dashboard = get_dashboard()
     results = {}
+    status = 200
     if request.method == "POST":
         try:
-            print_log("Webapp", "index", "Request = %s" % request.form)
-            depts = [d.strip() for d in request.form['dept-city'].split(',')]
-            dests = [d.strip() for d in request.form['dest-city'].split(',')]
-            dept_date = request.form['dept-date']
-            dest_date = request.form['dest-date']
-            interval = int(request.form['interval'])
-            carrier_filter = [c.strip() for c in request.form['carrier_filter'].split(',')]
-            welcome_carriers = [c for c in carrier_filter if len(c) > 0 and c[0] != '-']
-            unwelcome_carriers = [c[1:] for c in carrier_filter if len(c) > 0 and c[0] == '-']
-            start_date = datetime.strptime(dept_date, "%Y-%m-%d")
-            end_date = datetime.strptime(dest_date, "%Y-%m-%d")
-            date_diff = (end_date - start_date).days - interval + 1
-            result = []
-
-            for dept in depts:
-                for dest in dests:
-                    # Loop through each destination and departure
-                    dept = flight.top_autosuggest(dept)
-                    dest = flight.top_autosuggest(dest)
-                    for i in range(0, date_diff):
-                        from_date = start_date + timedelta(days=i)
-                        to_date = start_date + timedelta(days=i+interval)
-                        temp_result = flight.Query(dept_place=dept,
-                                              dest_place=dest,
-                                              outbounddate=from_date.strftime("%Y-%m-%d"),
-                                              inbounddate=to_date.strftime("%Y-%m-%d")
-                                        )
-                        result += temp_result.get_lowest_price(filter=partial(carrier_filtering,
-                                                                              welcome_carriers=welcome_carriers,
-                                                                              unwelcome_carriers=unwelcome_carriers))
-            result.sort(key=lambda x: x['Price'])
-
-            print_log("Webapp", "index", "Date diff = %d" % date_diff)
-            print_log("Webapp", "index", "Result = \n%s" % result)
-            results = {'result': result, 'currency': flight.currency}
+            print_log("Webapp", "index", "Request = %s", request.form, level=logging.DEBUG)
+            try:
+                search = dashboard.parse_search(request.form)
+            except ValueError:
+                status = 400
+                raise
+            with metrics.timed('search'):
+                result = dashboard.flight_search.search(search['tasks'], itinerary_filter=search['itinerary_filter'])
+
+            print_log("Webapp", "index", "Found %d itineraries in %d queries",
+                      len(result), len(search['tasks']))
+            print_log("Webapp", "index", "Result = \n%s", result, level=logging.DEBUG)
+            results = {'result': result, 'currency': dashboard.flight.currency}
         except Exception as ex:
-            print_log("Webapp", "index", request.form)
-            print_log("Webapp", "index", ex)
-    return render_template("index.html", **results)
+            print_log("Webapp", "index", "Search %s failed: %s", request.form, ex, level=logging.ERROR)
+    with metrics.timed('render'):
+        return render_template("index.html", **results), status
 
 
-def main():
+@webapp.route('/stream', methods=['GET'])
+def stream():
+    """
+    Streaming search callback. The lowest price itineraries of each query
+    are pushed as a server-sent event as soon as the query completes.
+    :return: Event stream
+    """
+    dashboard = get_dashboard()
+    args = request.args.to_dict()
+    try:
+        dashboard.check_search(args)
+    except ValueError as ex:
+        return jsonify({'error': str(ex)}), 400
+
+    def generate():
+        try:
+            print_log("Webapp", "stream", "Request = %s", args, level=logging.DEBUG)
+            search = dashboard.parse_search(args)
+            total = len(search['tasks'])
+            yield sse_event("start", {'currency': dashboard.flight.currency, 'total': total})
+            done = 0
+            for task, itineraries in dashboard.flight_search.iter_results(
+                    search['tasks'], itinerary_filter=search['itinerary_filter']):
+                done += 1
+                yield sse_event("result", {'query': repr(task),
+                                           'done': done,
+                                           'total': total,
+                                           'itineraries': itineraries})
+            yield sse_event("end", {'done': done, 'total': total})
+        except Exception as ex:
+            print_log("Webapp", "stream", "Search %s failed: %s", args, ex, level=logging.ERROR)
+            yield sse_event("error", {'message': str(ex)})
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@webapp.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Search job submission callback. The search runs in the background and
+    the same search submitted again while its result is kept returns the
+    same job.
+    :return: Job ID and URLs, 400 if the search conditions cannot be
+             combined, or 503 if too many jobs are waiting
+    """
+    dashboard = get_dashboard()
+    form = request.form.to_dict()
+    key = json.dumps(sorted(form.items()))
+    try:
+        dashboard.check_search(form)
+    except ValueError as ex:
+        return jsonify({'error': str(ex)}), 400
+
+    try:
+        job = dashboard.jobs.submit(key, lambda: dashboard.parse_search(form))
+    except queue.Full:
+        return jsonify({'error': 'Too many searches waiting, please retry later'}), 503, {'Retry-After': '30'}
+
+    return jsonify({'id': job.id,
+                    'state': job.state,
+                    'url': url_for('.job_status', job_id=job.id),
+                    'stream_url': url_for('.job_stream', job_id=job.id)}), 202
+
+
+@webapp.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+def job_status(job_id):
+    """
+    Search job callback. GET returns the job status, the query results after
+    the first ?since=n ones and all the itineraries so far sorted by price.
+    DELETE cancels the job.
+    :return: Job status
+    """
+    jobs = get_dashboard().jobs
+    if request.method == 'DELETE':
+        job = jobs.cancel(job_id)
+    else:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    try:
+        since = int(request.args.get('since', 0))
+        if since < 0:
+            raise ValueError(since)
+    except ValueError:
+        return jsonify({'error': 'Invalid since, expected a number of results'}), 400
+
+    return jsonify(job.status(since=since))
+
+
+@webapp.route('/jobs/<job_id>/stream', methods=['GET'])
+def job_stream(job_id):
+    """
+    Search job streaming callback. All the query results so far are sent
+    first, so a reloaded page or a shared link shows the whole search.
+    :return: Event stream
+    """
+    dashboard = get_dashboard()
+    job = dashboard.jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    def generate():
+        sent = 0
+        started = False
+        while True:
+            job.wait(sent, timeout=15)
+            status = job.status(since=sent, merged=False)
+            if not started and status['total'] is not None:
+                yield sse_event("start", {'currency': dashboard.flight.currency, 'id': job.id, 'total': status['total']})
+                started = True
+            for r in status['results']:
+                sent += 1
+                yield sse_event("result", {'query': r['query'],
+                                           'done': sent,
+                                           'total': status['total'],
+                                           'itineraries': r['itineraries']})
+            if status['state'] == job.FAILED:
+                yield sse_event("error", {'message': status['error']})
+                return
+            elif status['state'] in (job.DONE, job.CANCELLED):
+                yield sse_event("end", {'done': sent, 'total': status['total'], 'state': status['state']})
+                return
+            elif len(status['results']) == 0:
+                # Keep the connection alive through the proxies
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def export_response(columns, chunks, name):
+    """
+    Stream the rows as a file download in the format of ?format=, csv by default
+    :param columns: List of (name, type) of the columns
+    :param chunks: Iterable of the lists of rows
+    :param name: File name without the extension
+    :return: Streamed file, or 400 if the format is not supported
+    """
+    format = request.args.get('format', 'csv')
+    if format not in get_formats():
+        return jsonify({'error': "Unsupported format %s, supported: %s" % (format, ", ".join(get_formats()))}), 400
+
+    return Response(stream_with_context(iter_export(columns, chunks, format)),
+                    mimetype=MIME_TYPES[format],
+                    headers={'Content-Disposition': 'attachment; filename="%s.%s"' % (name, format)})
+
+
+@webapp.route('/jobs/<job_id>/export', methods=['GET'])
+def job_export(job_id):
+    """
+    Search job export callback. The itineraries found so far, sorted by
+    price, as a csv, parquet or arrow file.
+    :return: Streamed file
+    """
+    job = get_dashboard().jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    results = [(r['query'], r['itineraries']) for r in job.status(merged=False)['results']]
+    return export_response(ITINERARY_COLUMNS, chunked(itinerary_rows(results), 1000), "search-%s" % job.id)
+
+
+@webapp.route('/export/history', methods=['GET'])
+def history_export():
+    """
+    Price history export callback, filtered by ?origin=, ?destination= and
+    the observation dates ?since= and ?until=, as a csv, parquet or arrow
+    file. The rows are read and written in chunks.
+    :return: Streamed file
+    """
+    dashboard = get_dashboard()
+    sqlite_file_path = dashboard.flight.conf.get_sqlite_file_path()
+    if dashboard.analytics is None or not dashboard.analytics.has_history():
+        return jsonify({'error': "No price history, please run the price monitor with SQLITE_FILE_PATH"}), 404
+
+    # Validated here, as the rows are only read once the response streams
+    for name in ('since', 'until'):
+        try:
+            if request.args.get(name):
+                datetime.strptime(request.args[name], "%Y-%m-%d")
+        except ValueError:
+            return jsonify({'error': "Invalid %s %s, expected %%Y-%%m-%%d" % (name, request.args[name])}), 400
+
+    places = dashboard.flight.places
+    origin = request.args.get('origin')
+    destination = request.args.get('destination')
+    chunks = history_chunks(sqlite_file_path,
+                            origin=places.resolve(origin) if origin else None,
+                            destination=places.resolve(destination) if destination else None,
+                            since=request.args.get('since'),
+                            until=request.args.get('until'),
+                            chunk_size=dashboard.flight.conf.get_export_chunk_size())
+    return export_response(HISTORY_COLUMNS, chunks, "price-history")
+
+
+@webapp.route('/analytics', methods=['GET'])
+def analytics():
+    """
+    Price history analytics callback. The cheapest weeks and the departure
+    date x duration heatmap of the outbound dates, and the price trend of
+    the routes over the last days, as a page or in json with ?format=json.
+    :return: Analytics page
+    """
+    dashboard = get_dashboard()
+    today = datetime.now().date()
+    args = {'origin': request.args.get('origin', 'Hong Kong'),
+            'destinations': request.args.get('destinations', ''),
+            'start-date': request.args.get('start-date', (today + timedelta(days=1)).strftime("%Y-%m-%d")),
+            'end-date': request.args.get('end-date', (today + timedelta(days=90)).strftime("%Y-%m-%d")),
+            'days': request.args.get('days', '30'),
+            'percentile': request.args.get('percentile', '')}
+    views = {}
+    if dashboard.analytics is None or not dashboard.analytics.has_history():
+        views['error'] = "No price history, please run the price monitor with SQLITE_FILE_PATH"
+    else:
+        try:
+            places = dashboard.flight.places
+            origin = places.resolve(args['origin'])
+            destinations = [places.resolve(d.strip()) for d in args['destinations'].split(',') if d.strip()]
+            with metrics.timed('analytics'):
+                views['weeks'] = dashboard.analytics.cheapest_weeks(origin, destinations,
+                                                                    args['start-date'], args['end-date'])
+                views['heatmap'] = dashboard.analytics.heatmap(
+                    origin, destinations, args['start-date'], args['end-date'],
+                    percentile=float(args['percentile']) if args['percentile'] else None)
+                views['trends'] = dashboard.analytics.trend(origin, destinations, days=int(args['days']))
+        except Exception as ex:
+            print_log("Webapp", "analytics", "Analytics %s failed: %s", args, ex, level=logging.ERROR)
+            views['error'] = str(ex)
+
+    if request.args.get('format') == 'json':
+        return jsonify(views)
+    return render_template("analytics.html", args=args, currency=dashboard.flight.currency, **views)
+
+
+@webapp.route('/metrics', methods=['GET'])
+def metrics_page():
+    """
+    Metrics callback. The stage latency histograms, API calls and cache
+    counters in the Prometheus text format, or in json with ?format=json.
+    :return: Metrics
+    """
+    flight = get_dashboard().flight
+    cache_stats = flight.cache.stats()
+    lookups = cache_stats['hits'] + cache_stats['db_hits'] + cache_stats['misses']
+    cache_counters = {'cache_hits': cache_stats['hits'],
+                      'cache_db_hits': cache_stats['db_hits'],
+                      'cache_misses': cache_stats['misses'],
+                      'cache_evictions': cache_stats['evictions'],
+                      'coalesced_queries': flight.inflight.coalesced}
+    cache_gauges = {'cache_entries': cache_stats['entries'],
+                    'cache_hit_rate': (cache_stats['hits'] + cache_stats['db_hits']) / lookups
+                                      if lookups > 0 else 0.0}
+
+    if request.args.get('format') == 'json':
+        snapshot = metrics.snapshot()
+        snapshot['counters'].update(cache_counters)
+        snapshot['gauges'].update(cache_gauges)
+        return Response(json.dumps(snapshot), mimetype='application/json')
+
+    return Response(metrics.to_prometheus(extra_counters=cache_counters, extra_gauges=cache_gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def create_app(config_path):
+    """
+    App factory, e.g. for a WSGI server running several worker processes,
+    see wsgi.py
+    :param config_path: Configuration file path
+    :return: Flask app
+    """
+    app = Flask(__name__)
+    dashboard = Dashboard(config_path)
+    app.extensions['dashboard'] = dashboard
     app.register_blueprint(webapp)
+    dashboard.warm_up()
+    return app
+
+
+def main():
+    enable_ssl = False
+    if len(sys.argv) < 2 or len(sys.argv) > 3:
+        print("Usage: python run.py <config_file> (--ssl)")
+        sys.exit(0)
+    elif len(sys.argv) == 3:
+        if sys.argv[2] == "--ssl":
+            enable_ssl = True
+        else:
+            print("Usage: python run.py <config_file> (--ssl)")
+            sys.exit(0)
+
+    app = create_app(sys.argv[1])
     if enable_ssl:
         app.run(host=os.getenv('IP', '0.0.0.0'),port=int(os.getenv('PORT', 8080)), ssl_context='adhoc')
     else:
         app.run(host=os.getenv('IP', '0.0.0.0'),port=int(os.getenv('PORT', 8080)))
 
-main()    
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,551 @@
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from settings import print_log
+
+
+class SearchTask:
+    """
+    A single live pricing query in the search grid
+    """
+    def __init__(self, dept_place, dest_place, outbounddate, inbounddate):
+        """
+        :param dept_place - Departure place ID
+        :param dest_place - Destination place ID
+        :param outbounddate - Outbound date in %Y-%m-%d
+        :param inbounddate - Inbound date in %Y-%m-%d, one way if None
+        """
+        self.dept_place = dept_place
+        self.dest_place = dest_place
+        self.outbounddate = outbounddate
+        self.inbounddate = inbounddate
+
+    def __repr__(self):
+        return "%s-%s@%s/%s" % (self.dept_place,
+                                self.dest_place,
+                                self.outbounddate,
+                                self.inbounddate)
+
+
+class OpenJawTask:
+    """
+    An open jaw trip of the search grid, flying into one city and returning
+    from another. It is priced as two one way queries, which are shared
+    with the other trips of the grid.
+    """
+    def __init__(self, dept_place, dest_place, return_place, outbounddate, inbounddate):
+        """
+        :param dept_place - Departure place ID, where the trip returns to
+        :param dest_place - Destination place ID of the outbound leg
+        :param return_place - Departure place ID of the return leg
+        :param outbounddate - Outbound date in %Y-%m-%d
+        :param inbounddate - Return date in %Y-%m-%d
+        """
+        self.dept_place = dept_place
+        self.dest_place = dest_place
+        self.return_place = return_place
+        self.outbounddate = outbounddate
+        self.inbounddate = inbounddate
+
+    @property
+    def outbound_key(self):
+        return (self.dept_place, self.dest_place, self.outbounddate)
+
+    @property
+    def return_key(self):
+        return (self.return_place, self.dept_place, self.inbounddate)
+
+    def __repr__(self):
+        return "%s-%s/%s-%s@%s/%s" % (self.dept_place,
+                                      self.dest_place,
+                                      self.return_place,
+                                      self.dept_place,
+                                      self.outbounddate,
+                                      self.inbounddate)
+
+
+class FlexibleTask(SearchTask):
+    """
+    A date pair of the flexible date search, with the lower bound of its
+    price estimated from the cached prices
+    """
+    def __init__(self, dept_place, dest_place, outbounddate, inbounddate, lower_bound=0.0, quoted=False):
+        """
+        :param lower_bound - Estimated lowest price of the date pair
+        :param quoted - True if the lower bound is from a cached price of the
+                        date pair itself
+        """
+        SearchTask.__init__(self, dept_place, dest_place, outbounddate, inbounddate)
+        self.lower_bound = lower_bound
+        self.quoted = quoted
+
+
+class FlightSearch:
+    """
+    Runs the (departure, destination, outbound, inbound) grid of live pricing
+    queries on a bounded thread pool.
+    """
+    FLEXIBLE_NEARBY_DAYS = 3
+
+    def __init__(self, flight, max_concurrent_queries=None, cache_flight=None):
+        """
+        :param flight - FlightQuery object
+        :param max_concurrent_queries - Maximum number of queries in flight,
+                                        default from the configuration
+        :param cache_flight - FlightCacheQuery object for the two-tier search
+        """
+        self.flight = flight
+        self.cache_flight = cache_flight
+        if max_concurrent_queries is None:
+            max_concurrent_queries = flight.conf.get_max_concurrent_queries()
+        self.max_concurrent_queries = max(1, max_concurrent_queries)
+
+    def build_grid(self, depts, dests, start_date, date_diff, interval):
+        """
+        Build the search grid
+        :param depts - List of departure cities
+        :param dests - List of destination cities
+        :param start_date - First outbound date
+        :param date_diff - Number of outbound dates to search
+        :param interval - Number of days between outbound and inbound
+        :return List of SearchTask
+        """
+        places = self.flight.places.resolve_all(depts + dests)
+
+        tasks = []
+        for dept in depts:
+            for dest in dests:
+                for i in range(0, date_diff):
+                    from_date = start_date + timedelta(days=i)
+                    to_date = start_date + timedelta(days=i+interval)
+                    tasks.append(SearchTask(dept_place=places[dept],
+                                            dest_place=places[dest],
+                                            outbounddate=from_date.strftime("%Y-%m-%d"),
+                                            inbounddate=to_date.strftime("%Y-%m-%d")))
+
+        return tasks
+
+    def build_open_jaw_grid(self, depts, dests, returns, start_date, date_diff, interval):
+        """
+        Build the open jaw search grid, i.e. every destination combined with
+        every return city
+        :param depts - List of departure cities
+        :param dests - List of destination cities
+        :param returns - List of the cities to return from
+        :param start_date - First outbound date
+        :param date_diff - Number of outbound dates to search
+        :param interval - Number of days between outbound and return
+        :return List of OpenJawTask
+        """
+        places = self.flight.places.resolve_all(depts + dests + returns)
+
+        tasks = []
+        for dept in depts:
+            for dest in dests:
+                for ret in returns:
+                    for i in range(0, date_diff):
+                        from_date = start_date + timedelta(days=i)
+                        to_date = start_date + timedelta(days=i+interval)
+                        tasks.append(OpenJawTask(dept_place=places[dept],
+                                                 dest_place=places[dest],
+                                                 return_place=places[ret],
+                                                 outbounddate=from_date.strftime("%Y-%m-%d"),
+                                                 inbounddate=to_date.strftime("%Y-%m-%d")))
+
+        return tasks
+
+    def build_flexible_grid(self, depts, dests, start_date, end_date, min_interval, max_interval):
+        """
+        Build the flexible date search grid, i.e. every date pair in the
+        window with a duration in the range, and estimate the lower bound of
+        each date pair from the cached prices. The cached prices can be stale,
+        so they are discounted by FLEXIBLE_BOUND_DISCOUNT_PCT. A date pair
+        without a cached price is bounded by the lowest bound of the outbound
+        dates within FLEXIBLE_NEARBY_DAYS days, else by the lowest bound of
+        its route, or 0 if the route has no cached price at all.
+        :param depts - List of departure cities
+        :param dests - List of destination cities
+        :param start_date - First outbound date
+        :param end_date - Last inbound date
+        :param min_interval - Minimum number of days between outbound and inbound
+        :param max_interval - Maximum number of days between outbound and inbound
+        :return List of FlexibleTask
+        """
+        places = self.flight.places.resolve_all(depts + dests)
+
+        tasks = []
+        for dept in depts:
+            for dest in dests:
+                for interval in range(min_interval, max_interval + 1):
+                    for i in range(0, (end_date - start_date).days - interval + 1):
+                        from_date = start_date + timedelta(days=i)
+                        to_date = start_date + timedelta(days=i+interval)
+                        tasks.append(FlexibleTask(dept_place=places[dept],
+                                                  dest_place=places[dest],
+                                                  outbounddate=from_date.strftime("%Y-%m-%d"),
+                                                  inbounddate=to_date.strftime("%Y-%m-%d")))
+
+        prices = self.get_browse_prices(tasks) if self.cache_flight is not None and len(tasks) > 0 else {}
+        discount = 1 - self.flight.conf.get_flexible_bound_discount_pct() / 100
+        bounds = {}
+        route_bounds = {}
+        for task in tasks:
+            price = prices.get((task.dept_place, task.dest_place, task.outbounddate, task.inbounddate))
+            if price is not None:
+                task.lower_bound = price * discount
+                task.quoted = True
+                key = (task.dept_place, task.dest_place, task.outbounddate)
+                bounds[key] = min(bounds.get(key, task.lower_bound), task.lower_bound)
+                route = (task.dept_place, task.dest_place)
+                route_bounds[route] = min(route_bounds.get(route, task.lower_bound), task.lower_bound)
+
+        # The fares of the nearby outbound dates are the best estimate of a
+        # date pair without cached price
+        for task in tasks:
+            if task.quoted:
+                continue
+            outbound = datetime.strptime(task.outbounddate, "%Y-%m-%d")
+            nearby = [bounds.get((task.dept_place, task.dest_place,
+                                  (outbound + timedelta(days=d)).strftime("%Y-%m-%d")))
+                      for d in range(-FlightSearch.FLEXIBLE_NEARBY_DAYS, FlightSearch.FLEXIBLE_NEARBY_DAYS + 1)]
+            task.lower_bound = min([b for b in nearby if b is not None],
+                                   default=route_bounds.get((task.dept_place, task.dest_place), 0.0))
+
+        return tasks
+
+    def get_browse_prices(self, tasks):
+        """
+        Get the cached prices of the tasks, one browse query per route and
+        pair of outbound and inbound months
+        :param tasks - List of SearchTask
+        :return Dictionary of (departure, destination, outbound, inbound) to the
+                lowest cached price
+        """
+        months = set((t.dept_place, t.dest_place, t.outbounddate[:7], t.inbounddate[:7]) for t in tasks)
+
+        def browse(key):
+            try:
+                return key, self.cache_flight.get_browse_prices(*key)
+            except Exception as ex:
+                print_log(self.__class__.__name__,
+                          self.get_browse_prices.__name__,
+                          "Browse query %s failed: %s", list(key), ex,
+                          level=logging.WARNING)
+                return key, {}
+
+        prices = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_queries) as executor:
+            for key, quotes in executor.map(browse, months):
+                for (outbounddate, inbounddate), price in quotes.items():
+                    prices[(key[0], key[1], outbounddate, inbounddate)] = price
+
+        return prices
+
+    def shortlist(self, tasks, top_k=None):
+        """
+        Keep the top-k date pairs of each route by their cached price. The
+        date pairs without a cached price are ranked after the others.
+        :param tasks - List of SearchTask
+        :param top_k - Number of date pairs per route, default from the
+                       configuration
+        :return List of SearchTask
+        """
+        if top_k is None:
+            top_k = self.flight.conf.get_live_top_k()
+
+        prices = self.get_browse_prices(tasks)
+        routes = {}
+        for task in tasks:
+            price = prices.get((task.dept_place, task.dest_place, task.outbounddate, task.inbounddate))
+            routes.setdefault((task.dept_place, task.dest_place), []).append((price, task))
+
+        shortlisted = []
+        for candidates in routes.values():
+            candidates.sort(key=lambda c: (c[0] is None, c[0] or 0))
+            shortlisted += [c[1] for c in candidates[:top_k]]
+
+        print_log(self.__class__.__name__,
+                  self.shortlist.__name__,
+                  "Shortlisted %d of %d queries", len(shortlisted), len(tasks))
+        return shortlisted
+
+    def run_task(self, task, n_itinerary=3, filter=None, itinerary_filter=None):
+        """
+        Run a single query of the grid
+        :param task - SearchTask
+        :param n_itinerary - The number of lowest price itineraries
+        :param filter - Filter on the readable itinerary dictionary
+        :param itinerary_filter - Filter on the FlightItinerary
+        :return The first n-th lowest price itineraries of the task
+        """
+        result = self.flight.Query(dept_place=task.dept_place,
+                                   dest_place=task.dest_place,
+                                   outbounddate=task.outbounddate,
+                                   inbounddate=task.inbounddate)
+        return result.get_lowest_price(n_itinerary=n_itinerary,
+                                       filter=filter,
+                                       itinerary_filter=itinerary_filter)
+
+    def run_open_jaw_leg(self, task, n_itinerary=3, filter=None, itinerary_filter=None):
+        """
+        Run the one way query of a leg of open jaw trips
+        :param task - SearchTask of the leg
+        :param n_itinerary - The number of lowest price itineraries
+        :param filter - Filter on the readable itinerary dictionary
+        :param itinerary_filter - ItineraryFilter of the leg
+        :return Tuple of the first n-th lowest price itineraries of the leg,
+                and of those with a welcome carrier
+        """
+        result = self.flight.Query(dept_place=task.dept_place,
+                                   dest_place=task.dest_place,
+                                   outbounddate=task.outbounddate,
+                                   inbounddate=task.inbounddate)
+        if itinerary_filter is None or len(itinerary_filter.welcome_carriers) == 0:
+            itineraries = result.get_lowest_price(n_itinerary=n_itinerary,
+                                                  filter=filter,
+                                                  itinerary_filter=itinerary_filter)
+            return itineraries, itineraries
+
+        return (result.get_lowest_price(n_itinerary=n_itinerary,
+                                        filter=filter,
+                                        itinerary_filter=itinerary_filter.without_carriers()),
+                result.get_lowest_price(n_itinerary=n_itinerary,
+                                        filter=filter,
+                                        itinerary_filter=itinerary_filter))
+
+    def iter_results(self, tasks, n_itinerary=3, filter=None, itinerary_filter=None, task_filters=None,
+                     run_task=None):
+        """
+        Run the tasks concurrently and yield the results as they complete.
+        A failed task is logged and skipped.
+        :param tasks - List of SearchTask, or of OpenJawTask
+        :param n_itinerary - The number of lowest price itineraries per task
+        :param filter - Filter on the readable itinerary dictionary
+        :param itinerary_filter - Filter on the FlightItinerary
+        :param task_filters - Dictionary of task to its own itinerary filter
+        :param run_task - Function running a task, default run_task
+        :return Generator of (task, itineraries)
+        """
+        if len(tasks) > 0 and isinstance(tasks[0], OpenJawTask):
+            yield from self.iter_open_jaw_results(tasks, n_itinerary, filter, itinerary_filter)
+            return
+        if len(tasks) > 0 and isinstance(tasks[0], FlexibleTask):
+            yield from self.iter_flexible_results(tasks, n_itinerary, filter, itinerary_filter)
+            return
+
+        task_filters = task_filters or {}
+        run_task = run_task or self.run_task
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent_queries)
+        try:
+            futures = dict((executor.submit(run_task, task, n_itinerary, filter,
+                                            task_filters.get(task, itinerary_filter)), task)
+                           for task in tasks)
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    itineraries = future.result()
+                except Exception as ex:
+                    print_log(self.__class__.__name__,
+                              self.iter_results.__name__,
+                              "Query %s failed: %s", task, ex,
+                              level=logging.WARNING)
+                    continue
+
+                yield task, itineraries
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def combine_legs(outbounds, returns, n_itinerary):
+        """
+        Combine the ranked one way itineraries of the two legs of a trip
+        :param outbounds - Outbound itineraries sorted by price
+        :param returns - Return itineraries sorted by price
+        :param n_itinerary - The number of lowest price combinations
+        :return The first n-th lowest price combinations, sorted by price
+        """
+        # The combinations are expanded from the cheapest pair in price order
+        heap = [(outbounds[0]['Price'] + returns[0]['Price'], 0, 0)] if outbounds and returns else []
+        visited = set()
+        combined = []
+        while len(heap) > 0 and len(combined) < n_itinerary:
+            price, i, j = heapq.heappop(heap)
+            combined.append({'OutboundLeg': outbounds[i]['OutboundLeg'],
+                             'InboundLeg': dict(returns[j]['OutboundLeg'], Directionality='Inbound'),
+                             'Price': price})
+            for ni, nj in ((i + 1, j), (i, j + 1)):
+                if ni < len(outbounds) and nj < len(returns) and (ni, nj) not in visited:
+                    visited.add((ni, nj))
+                    heapq.heappush(heap, (outbounds[ni]['Price'] + returns[nj]['Price'], ni, nj))
+
+        return combined
+
+    @staticmethod
+    def combine_open_jaw(outbound, ret, n_itinerary):
+        """
+        Combine the legs of an open jaw trip. As on a round trip, a welcome
+        carrier on either leg is enough, so the trips are those combining
+        a welcome outbound leg with any return leg, or any outbound leg with
+        a welcome return leg.
+        :param outbound - Tuple of the outbound itineraries, and of those with
+                          a welcome carrier, sorted by price
+        :param ret - Tuple of the return itineraries, and of those with a
+                     welcome carrier, sorted by price
+        :param n_itinerary - The number of lowest price combinations
+        :return The first n-th lowest price combinations, sorted by price
+        """
+        (outbounds, welcome_outbounds), (returns, welcome_returns) = outbound, ret
+        if outbounds is welcome_outbounds:
+            return FlightSearch.combine_legs(outbounds, returns, n_itinerary)
+
+        merged = heapq.merge(FlightSearch.combine_legs(welcome_outbounds, returns, n_itinerary),
+                             FlightSearch.combine_legs(outbounds, welcome_returns, n_itinerary),
+                             key=lambda x: x['Price'])
+        combined = []
+        seen = set()
+        for trip in merged:
+            key = (trip['OutboundLeg']['Id'], trip['InboundLeg']['Id'])
+            if key not in seen:
+                seen.add(key)
+                combined.append(trip)
+                if len(combined) == n_itinerary:
+                    break
+
+        return combined
+
+    def iter_open_jaw_results(self, tasks, n_itinerary=3, filter=None, itinerary_filter=None):
+        """
+        Run the open jaw tasks as the unique one way queries of their legs,
+        and yield each trip as soon as both of its legs complete. The number
+        of queries is the number of unique legs, not of trips.
+        :param tasks - List of OpenJawTask
+        :param n_itinerary - The number of lowest price itineraries per trip
+        :param filter - Filter on the readable itinerary dictionary of a leg
+        :param itinerary_filter - ItineraryFilter
+        :return Generator of (task, itineraries)
+        """
+        legs = {}
+        for task in tasks:
+            legs.setdefault(task.outbound_key, SearchTask(*task.outbound_key, inbounddate=None))
+            legs.setdefault(task.return_key, SearchTask(*task.return_key, inbounddate=None))
+
+        # The departure time window only applies to the outbound legs
+        return_filter = None if itinerary_filter is None else itinerary_filter.for_return_leg()
+        outbound_keys = set(task.outbound_key for task in tasks)
+        task_filters = dict((leg, return_filter) for k, leg in legs.items() if k not in outbound_keys)
+
+        print_log(self.__class__.__name__,
+                  self.iter_open_jaw_results.__name__,
+                  "%d trips from %d one way queries", len(tasks), len(legs))
+
+        waiting = {}
+        for task in tasks:
+            waiting.setdefault(task.outbound_key, []).append(task)
+            if task.return_key != task.outbound_key:
+                waiting.setdefault(task.return_key, []).append(task)
+
+        # The top n combinations only use the top n itineraries of each leg
+        done = {}
+        max_price = None if itinerary_filter is None else itinerary_filter.max_price
+        results = self.iter_results(list(legs.values()), n_itinerary, filter, itinerary_filter, task_filters,
+                                    run_task=self.run_open_jaw_leg)
+        try:
+            for leg, itineraries in results:
+                key = (leg.dept_place, leg.dest_place, leg.outbounddate)
+                done[key] = itineraries
+                for task in waiting.pop(key, []):
+                    if task.outbound_key in done and task.return_key in done:
+                        combined = self.combine_open_jaw(done[task.outbound_key], done[task.return_key],
+                                                         n_itinerary)
+                        yield task, [c for c in combined if max_price is None or c['Price'] <= max_price]
+        finally:
+            results.close()
+
+    def iter_flexible_results(self, tasks, n_itinerary=3, filter=None, itinerary_filter=None,
+                              top_n=None, max_queries=None):
+        """
+        Branch and bound over the date pairs of a flexible date search. The
+        date pairs with a cached price are priced live in the order of their
+        lower bounds, then those with an estimated one, as in shortlist. A
+        date pair is pruned if its lower bound cannot beat the current top-n
+        date pairs, and the search stops once the live query budget is used
+        up.
+        :param tasks - List of FlexibleTask
+        :param n_itinerary - The number of lowest price itineraries per task
+        :param filter - Filter on the readable itinerary dictionary
+        :param itinerary_filter - Filter on the FlightItinerary
+        :param top_n - Number of the cheapest date pairs to find, default
+                       from the configuration
+        :param max_queries - Maximum number of live queries, default from the
+                             configuration
+        :return Generator of (task, itineraries)
+        """
+        if top_n is None:
+            top_n = self.flight.conf.get_flexible_top_n()
+        if max_queries is None:
+            max_queries = self.flight.conf.get_flexible_max_queries()
+        max_price = None if itinerary_filter is None else itinerary_filter.max_price
+
+        # Max heap of the lowest price of the top n date pairs
+        best = []
+        pending = sorted(tasks, key=lambda t: (not t.quoted, t.lower_bound))
+        n_queries = 0
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent_queries)
+        futures = {}
+        try:
+            while True:
+                threshold = -best[0] if len(best) >= top_n else max_price
+                while len(pending) > 0 and len(futures) < self.max_concurrent_queries:
+                    if n_queries >= max_queries:
+                        pending = []
+                        break
+                    task = pending.pop(0)
+                    if threshold is not None and task.lower_bound >= threshold:
+                        continue
+                    futures[executor.submit(self.run_task, task, n_itinerary, filter, itinerary_filter)] = task
+                    n_queries += 1
+
+                if len(futures) == 0:
+                    break
+
+                future = next(as_completed(futures))
+                task = futures.pop(future)
+                try:
+                    itineraries = future.result()
+                except Exception as ex:
+                    print_log(self.__class__.__name__,
+                              self.iter_flexible_results.__name__,
+                              "Query %s failed: %s", task, ex,
+                              level=logging.WARNING)
+                    continue
+
+                if len(itineraries) > 0:
+                    heapq.heappush(best, -itineraries[0]['Price'])
+                    if len(best) > top_n:
+                        heapq.heappop(best)
+
+                yield task, itineraries
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        print_log(self.__class__.__name__,
+                  self.iter_flexible_results.__name__,
+                  "Priced %d of %d date pairs live", n_queries, len(tasks))
+
+    def search(self, tasks, n_itinerary=3, filter=None, itinerary_filter=None):
+        """
+        Run the whole grid
+        :param tasks - List of SearchTask
+        :param n_itinerary - The number of lowest price itineraries per task
+        :param filter - Filter on the readable itinerary dictionary
+        :param itinerary_filter - Filter on the FlightItinerary
+        :return All the itineraries sorted by price
+        """
+        # Imported here, as the query module loads the API client which the
+        # monitor does not need unless a query is due
+        from query import FlightQuery
+        ranked = [itineraries for _, itineraries in
+                  self.iter_results(tasks, n_itinerary, filter, itinerary_filter)]
+
+        return FlightQuery.FlightQueryResult.merge_ranked(ranked)
@@ -0,0 +1,517 @@
+import sys
+import atexit
+import configparser
+import functools
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+logger = logging.getLogger('skyscannerdashboard')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+log_listener = None
+log_lock = threading.Lock()
+
+
+class LogMessage:
+    """
+    Log message formatted only when it is written out
+    """
+    __slots__ = ('msg', 'args')
+
+    def __init__(self, msg, args):
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        return str(self.msg) % self.args if len(self.args) > 0 else str(self.msg)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler leaving the formatting to the listener thread
+    """
+    def prepare(self, record):
+        return record
+
+
+def start_logger():
+    """
+    Start the listener thread writing the log records to stdout. The
+    callers of print_log only put the records on a queue.
+    """
+    global log_listener
+    with log_lock:
+        if log_listener is not None:
+            return
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s",
+                                               "%Y-%m-%d %H:%M:%S"))
+        log_queue = queue.SimpleQueue()
+        log_listener = logging.handlers.QueueListener(log_queue, handler)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        logger.addHandler(DeferredQueueHandler(log_queue))
+
+
+def set_log_level(level):
+    """
+    :param level - Level name, e.g. DEBUG, INFO or WARNING
+    """
+    logger.setLevel(level.upper())
+
+
+def print_log(class_name, method_name, log_msg, *args, level=logging.INFO):
+    """
+    Log a message without blocking on the output
+    :param class_name - Class name
+    :param method_name - Method name
+    :param log_msg - Message, formatted with args by the listener thread
+                     only if the level is enabled
+    :param level - Log level
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if log_listener is None:
+        start_logger()
+    logger.log(level, "[%s::%s] - %s", class_name, method_name, LogMessage(log_msg, args))
+
+
+def setting(getter):
+    """
+    Decorator of the configuration getters. The value is parsed and
+    converted on the first call only, and an invalid value is reported with
+    its key.
+    """
+    @functools.wraps(getter)
+    def wrapper(self):
+        try:
+            return self.parsed[getter.__name__]
+        except KeyError:
+            pass
+
+        try:
+            value = getter(self)
+        except ValueError as ex:
+            raise ValueError("Invalid %s in %s: %s" % (getter.__name__[4:].upper(), self.path, ex)) from ex
+        self.parsed[getter.__name__] = value
+        return value
+
+    return wrapper
+
+
+class config(configparser.ConfigParser):
+    """
+    Configuration object. The file is parsed and validated once, and the
+    typed values are kept, see load.
+    """
+    # Options without a default
+    REQUIRED = ('API_KEY', 'MARKET', 'CURRENCY', 'LOCALE', 'ADULTS',
+                'QUERY_INIT_DELAY_SEC', 'QUERY_DELAY_SEC')
+
+    loaded = {}
+    loaded_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        :param path - Configuration file path
+        """
+        configparser.ConfigParser.__init__(self)
+        self.path = path
+        self.parsed = {}
+        if len(self.read(path)) == 0:
+            raise ValueError("Cannot read the configuration file %s" % path)
+        self.validate()
+        set_log_level(self.get_log_level())
+        print_log(self.__class__.__name__,
+                  self.__init__.__name__,
+                  "Configuration path = %s", path,
+                  level=logging.DEBUG)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path - Configuration file path
+        :return The configuration of the file, parsed once per process
+        """
+        with cls.loaded_lock:
+            conf = cls.loaded.get(path)
+            if conf is None:
+                conf = cls(path)
+                cls.loaded[path] = conf
+        return conf
+
+    def validate(self):
+        """
+        Parse all the options, so that an invalid value fails at the startup
+        rather than in the middle of a search. The options used only by some
+        of the tools, e.g. DEPARTURE_CITIES by the monitor, can be missing.
+        """
+        missing = [k for k in config.REQUIRED if not self.has_option('DEFAULT', k)]
+        if len(missing) > 0:
+            raise ValueError("Missing %s in %s" % (", ".join(missing), self.path))
+
+        for name in dir(self):
+            if name.startswith('get_') and hasattr(getattr(config, name), '__wrapped__'):
+                try:
+                    getattr(self, name)()
+                except configparser.NoOptionError:
+                    pass
+
+    @setting
+    def get_api_key(self):
+        """
+        API key getter 
+        """            
+        return self.get('DEFAULT','API_KEY').strip()
+    
+    @setting
+    def get_market(self):
+        """
+        Market getter 
+        """
+        return self.get('DEFAULT','MARKET').strip()
+
+    @setting
+    def get_currency(self):
+        """
+        Currency getter 
+        """
+        return self.get('DEFAULT','CURRENCY').strip()
+
+    @setting
+    def get_locale(self):
+        """
+        Locale getter 
+        """
+        return self.get('DEFAULT','LOCALE').strip()
+
+    @setting
+    def get_adults(self):
+        """
+        Adults getter 
+        """
+        return int(self.get('DEFAULT','ADULTS').strip())
+
+    @setting
+    def get_query_init_delay_sec(self):
+        """
+        Query initial delay time in seconds
+        """
+        return int(self.get('DEFAULT','QUERY_INIT_DELAY_SEC').strip())
+
+    @setting
+    def get_query_delay_sec(self):
+        """
+        Query delay time in seconds, i.e. the maximum interval between the
+        polls of a session
+        """
+        return int(self.get('DEFAULT','QUERY_DELAY_SEC').strip())
+
+    @setting
+    def get_poll_min_delay_sec(self):
+        """
+        Minimum interval between the polls of a session in seconds
+        """
+        return float(self.get('DEFAULT', 'POLL_MIN_DELAY_SEC', fallback='1').strip())
+
+    @setting
+    def get_poll_deadline_sec(self):
+        """
+        Maximum time to poll a session in seconds
+        """
+        return float(self.get('DEFAULT', 'POLL_DEADLINE_SEC', fallback='60').strip())
+
+    @setting
+    def get_poll_stable_polls(self):
+        """
+        Number of consecutive polls with the same cheapest itineraries to
+        stop polling a session early, 0 to always poll to completion
+        """
+        return int(self.get('DEFAULT', 'POLL_STABLE_POLLS', fallback='2').strip())
+
+    @setting
+    def get_poll_stable_top_n(self):
+        """
+        Number of cheapest itineraries compared between the polls
+        """
+        return int(self.get('DEFAULT', 'POLL_STABLE_TOP_N', fallback='3').strip())
+
+    @setting
+    def get_max_concurrent_queries(self):
+        """
+        Maximum number of live pricing queries running concurrently
+        """
+        return int(self.get('DEFAULT', 'MAX_CONCURRENT_QUERIES', fallback='4').strip())
+    
+    @setting
+    def get_search_days(self):
+        """
+        Total number of days to search
+        """
+        return int(self.get('DEFAULT', 'SEARCH_DAYS').strip())
+        
+    @setting
+    def get_travel_interval_days(self):
+        """
+        Travel interval days. First value is the lower range while the second
+        is the higher
+        """
+        interval = self.get('DEFAULT', 'TRAVEL_INTERVAL_DAYS').split('-')
+        interval = [int(e.strip()) for e in interval]
+        if interval[0] > interval[-1]:
+            raise ValueError("the lower range is above the higher")
+        return interval[0:2]
+    
+    @setting
+    def get_departure_cities(self):
+        """
+        List of departure cities
+        """
+        cities = self.get('DEFAULT', 'DEPARTURE_CITIES').split(',')
+        return [e.strip() for e in cities]
+        
+    @setting
+    def get_destination_cities(self):
+        """
+        List of destination cities
+        """
+        cities = self.get('DEFAULT', 'DESTINATION_CITIES').split(',')
+        return [e.strip() for e in cities]
+        
+    @setting
+    def get_sqlite_file_path(self):
+        """
+        Sqlite file path, empty if not configured
+        """
+        return self.get('DEFAULT', 'SQLITE_FILE_PATH', fallback='').strip()
+
+    @setting
+    def get_lazy_parsing(self):
+        """
+        Whether the query results are parsed lazily
+        """
+        return self.getboolean('DEFAULT', 'LAZY_PARSING', fallback=True)
+
+    @setting
+    def get_place_index_file_path(self):
+        """
+        Place index file path, empty if not configured
+        """
+        return self.get('DEFAULT', 'PLACE_INDEX_FILE_PATH', fallback='').strip()
+
+    @setting
+    def get_live_top_k(self):
+        """
+        Number of date pairs per route priced live in a two-tier search
+        """
+        return int(self.get('DEFAULT', 'LIVE_TOP_K', fallback='5').strip())
+
+    @setting
+    def get_flexible_top_n(self):
+        """
+        Number of the cheapest date pairs found by a flexible date search
+        """
+        return int(self.get('DEFAULT', 'FLEXIBLE_TOP_N', fallback='5').strip())
+
+    @setting
+    def get_flexible_max_queries(self):
+        """
+        Maximum number of live queries of a flexible date search
+        """
+        return int(self.get('DEFAULT', 'FLEXIBLE_MAX_QUERIES', fallback='30').strip())
+
+    @setting
+    def get_flexible_bound_discount_pct(self):
+        """
+        Discount in percent on the cached prices to take them as the lower
+        bounds of the live prices
+        """
+        return float(self.get('DEFAULT', 'FLEXIBLE_BOUND_DISCOUNT_PCT', fallback='10').strip())
+
+    @setting
+    def get_export_chunk_size(self):
+        """
+        Number of rows read and written at a time by the exports
+        """
+        return int(self.get('DEFAULT', 'EXPORT_CHUNK_SIZE', fallback='10000').strip())
+
+    @setting
+    def get_api_host(self):
+        """
+        API host replacing the Skyscanner one, e.g. http://127.0.0.1:8800 for
+        stub_server.py, empty for the Skyscanner API
+        """
+        return self.get('DEFAULT', 'API_HOST', fallback='').strip().rstrip('/')
+
+    @setting
+    def get_http_transport(self):
+        """
+        HTTP transport, one of pooled, record and replay
+        """
+        return self.get('DEFAULT', 'HTTP_TRANSPORT', fallback='pooled').strip().lower()
+
+    @setting
+    def get_http_record_dir(self):
+        """
+        Directory of the recorded responses of the record and replay transports
+        """
+        return self.get('DEFAULT', 'HTTP_RECORD_DIR', fallback='records').strip()
+
+    @setting
+    def get_http_timeout_sec(self):
+        """
+        Timeout of each HTTP request in seconds
+        """
+        return float(self.get('DEFAULT', 'HTTP_TIMEOUT_SEC', fallback='30').strip())
+
+    @setting
+    def get_http_max_retries(self):
+        """
+        Maximum number of retries of a HTTP request on 429, 5xx or connection errors
+        """
+        return int(self.get('DEFAULT', 'HTTP_MAX_RETRIES', fallback='3').strip())
+
+    @setting
+    def get_history_batch_size(self):
+        """
+        Number of price observations written per transaction
+        """
+        return int(self.get('DEFAULT', 'HISTORY_BATCH_SIZE', fallback='500').strip())
+
+    @setting
+    def get_api_requests_per_minute(self):
+        """
+        API request budget per minute of the monitor
+        """
+        return int(self.get('DEFAULT', 'API_REQUESTS_PER_MINUTE', fallback='60').strip())
+
+    @setting
+    def get_monitor_min_refresh_sec(self):
+        """
+        Minimum refresh interval of a monitored query in seconds
+        """
+        return int(self.get('DEFAULT', 'MONITOR_MIN_REFRESH_SEC', fallback='3600').strip())
+
+    @setting
+    def get_monitor_max_refresh_sec(self):
+        """
+        Maximum refresh interval of a monitored query in seconds
+        """
+        return int(self.get('DEFAULT', 'MONITOR_MAX_REFRESH_SEC', fallback='86400').strip())
+
+    @setting
+    def get_alert_sinks(self):
+        """
+        List of the price alert sinks, e.g. file:alerts.jsonl, webhook:<url>
+        or smtp:localhost:25
+        """
+        sinks = self.get('DEFAULT', 'ALERT_SINKS', fallback='').split(',')
+        return [e.strip() for e in sinks if len(e.strip()) > 0]
+
+    @setting
+    def get_alert_drop_pct(self):
+        """
+        Minimum price drop from the last price seen to raise an alert, in percent
+        """
+        return float(self.get('DEFAULT', 'ALERT_DROP_PCT', fallback='10').strip())
+
+    @setting
+    def get_alert_email_from(self):
+        """
+        Sender address of the price alert emails
+        """
+        return self.get('DEFAULT', 'ALERT_EMAIL_FROM', fallback='monitor@localhost').strip()
+
+    @setting
+    def get_alert_email_to(self):
+        """
+        List of the recipient addresses of the price alert emails
+        """
+        addresses = self.get('DEFAULT', 'ALERT_EMAIL_TO', fallback='').split(',')
+        return [e.strip() for e in addresses if len(e.strip()) > 0]
+
+    @setting
+    def get_cache_ttl_sec(self):
+        """
+        Time to live of the cached query results in seconds
+        """
+        return int(self.get('DEFAULT', 'CACHE_TTL_SEC', fallback='900').strip())
+
+    @setting
+    def get_cache_partial_ttl_sec(self):
+        """
+        Maximum time to live of the cached result of a session returned
+        before it was complete, in seconds
+        """
+        return int(self.get('DEFAULT', 'CACHE_PARTIAL_TTL_SEC', fallback='60').strip())
+
+    @setting
+    def get_cache_route_ttl_sec(self):
+        """
+        Time to live of the cached query results per route, in the format
+        of <origin>:<destination>=<seconds>, separated by comma
+        """
+        ret = {}
+        for item in self.get('DEFAULT', 'CACHE_ROUTE_TTL_SEC', fallback='').split(','):
+            if len(item.strip()) == 0:
+                continue
+            route, ttl = item.split('=')
+            origin, destination = route.split(':')
+            ret[(origin.strip(), destination.strip())] = int(ttl.strip())
+        return ret
+
+    @setting
+    def get_cache_max_entries(self):
+        """
+        Maximum number of query results cached in memory
+        """
+        return int(self.get('DEFAULT', 'CACHE_MAX_ENTRIES', fallback='256').strip())
+
+    @setting
+    def get_log_level(self):
+        """
+        Log level getter, e.g. DEBUG, INFO or WARNING
+        """
+        level = self.get('DEFAULT','LOG_LEVEL', fallback='INFO').strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError("unknown level %s" % level)
+        return level
+
+    @setting
+    def get_cache_max_db_entries(self):
+        """
+        Maximum number of query results cached in the sqlite file
+        """
+        return int(self.get('DEFAULT', 'CACHE_MAX_DB_ENTRIES', fallback='10000').strip())
+
+    @setting
+    def get_warm_up_cities(self):
+        """
+        List of cities resolved when the server starts
+        """
+        cities = self.get('DEFAULT', 'WARM_UP_CITIES', fallback='').split(',')
+        return [e.strip() for e in cities if len(e.strip()) > 0]
+
+    @setting
+    def get_job_workers(self):
+        """
+        Number of background search jobs running at the same time
+        """
+        return int(self.get('DEFAULT', 'JOB_WORKERS', fallback='2').strip())
+
+    @setting
+    def get_job_queue_size(self):
+        """
+        Number of background search jobs waiting for a worker
+        """
+        return int(self.get('DEFAULT', 'JOB_QUEUE_SIZE', fallback='16').strip())
+
+    @setting
+    def get_job_result_ttl_sec(self):
+        """
+        Time to keep the result of a finished search job in seconds
+        """
+        return int(self.get('DEFAULT', 'JOB_RESULT_TTL_SEC', fallback='3600').strip())
@@ -0,0 +1,123 @@
+/*
+ * Streaming search. The form is submitted as a search job, whose results are
+ * streamed as server-sent events, and the result table is kept sorted by
+ * price as the queries complete.
+ */
+$(function() {
+    var form = $("#search-form");
+    var body = $("#search-result");
+    var progress = $("#search-progress");
+    var source = null;
+
+    if (typeof EventSource === "undefined") {
+        return;
+    }
+
+    function carrier(leg) {
+        return leg.Carriers.length > 0 ? leg.Carriers[0] : "";
+    }
+
+    function makeRow(currency, r) {
+        var row = $("<tr>").data("price", r.Price);
+        // One way itineraries have no inbound leg
+        var inbound = r.InboundLeg || {OriginStation: "", Departure: "", Arrival: "", Carriers: []};
+        row.append($("<th>").attr("scope", "row"));
+        $.each([currency + " " + r.Price,
+                r.OutboundLeg.DestinationStation,
+                r.OutboundLeg.Departure,
+                r.OutboundLeg.Arrival,
+                carrier(r.OutboundLeg),
+                inbound.OriginStation,
+                inbound.Departure,
+                inbound.Arrival,
+                carrier(inbound)], function(i, value) {
+            row.append($("<td>").text(value));
+        });
+        return row;
+    }
+
+    function insertRow(row) {
+        // Binary search for the first row with a higher price
+        var rows = body.children("tr");
+        var price = row.data("price");
+        var lo = 0, hi = rows.length;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if ($(rows[mid]).data("price") <= price) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        if (lo == rows.length) {
+            body.append(row);
+        } else {
+            row.insertBefore(rows[lo]);
+        }
+    }
+
+    function openStream(url) {
+        if (source !== null) {
+            source.close();
+        }
+
+        var currency = "";
+        var jobId = null;
+        body.empty();
+        source = new EventSource(url);
+
+        source.addEventListener("start", function(e) {
+            var data = JSON.parse(e.data);
+            currency = data.currency;
+            jobId = data.id || null;
+            progress.text("0 / " + data.total);
+        });
+
+        source.addEventListener("result", function(e) {
+            var data = JSON.parse(e.data);
+            $.each(data.itineraries, function(i, r) {
+                insertRow(makeRow(currency, r));
+            });
+            progress.text(data.done + " / " + data.total);
+        });
+
+        source.addEventListener("end", function(e) {
+            var data = JSON.parse(e.data);
+            progress.text((data.state == "cancelled" ? "Cancelled " : "Done ") + data.done + " / " + data.total);
+            if (jobId !== null) {
+                progress.append(" ").append($("<a>")
+                    .attr("href", form.data("jobs-url") + "/" + jobId + "/export")
+                    .text("Download CSV"));
+            }
+            source.close();
+        });
+
+        source.addEventListener("error", function(e) {
+            if (e.data) {
+                progress.text("Error: " + JSON.parse(e.data).message);
+            }
+            source.close();
+        });
+    }
+
+    form.on("submit", function(event) {
+        event.preventDefault();
+        progress.text("Searching...");
+        // The search runs as a background job. The job ID is kept in the
+        // page URL, so a reload or a shared link shows its results again.
+        $.post(form.data("jobs-url"), form.serialize())
+            .done(function(job) {
+                history.replaceState(null, "", "?job=" + job.id);
+                openStream(job.stream_url);
+            })
+            .fail(function(xhr) {
+                progress.text("Error: " + (xhr.responseJSON ? xhr.responseJSON.error : xhr.statusText));
+            });
+    });
+
+    var job = new RegExp("[?&]job=([0-9a-f]+)").exec(window.location.search);
+    if (job !== null) {
+        progress.text("Loading...");
+        openStream(form.data("jobs-url") + "/" + job[1] + "/stream");
+    }
+});
@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import math
+import random
+import statistics
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from settings import print_log
+from synthetic import generate_response
+
+
+class StubApi:
+    """
+    Local stand-in of the Skyscanner endpoints used by the dashboard, i.e.
+    the live pricing sessions, the browse cache and the location
+    autosuggest, serving seeded synthetic responses. The responses of a
+    route and date pair are the same across runs, and its cached prices
+    follow its live prices, so that the caching and the two-tier searches
+    behave as on the real API.
+    """
+    SESSION_TTL_SEC = 300
+
+    def __init__(self, n_itinerary=500, latency_ms=50.0, error_rate=0.0, complete_sec=2.0,
+                 base_price=4000.0, seed=0):
+        """
+        :param n_itinerary - Number of itineraries of a complete live pricing
+                             response
+        :param latency_ms - Average latency of a request in milliseconds
+        :param error_rate - Fraction of the requests failing with 429 or 500
+        :param complete_sec - Time for a session to complete. The itineraries
+                              are added progressively until then.
+        :param base_price - Typical lowest price
+        :param seed - Random seed of the responses
+        """
+        self.n_itinerary = n_itinerary
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.complete_sec = complete_sec
+        self.base_price = base_price
+        self.seed = seed
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        # Expected lowest price among the itineraries of a response, see
+        # generate_response, which the cached prices are drawn around
+        self.lowest_ratio = math.exp(0.3 + 0.35 * statistics.NormalDist().inv_cdf(1.0 / (n_itinerary + 1)))
+
+    def key_seed(self, *key):
+        """
+        :return Seed of the key, stable across processes unlike hash()
+        """
+        return zlib.crc32(json.dumps([self.seed] + list(key)).encode('utf-8'))
+
+    def route_price(self, origin, destination, outbounddate, inbounddate):
+        """
+        Typical price of a date pair. It varies by route, season, day of week
+        and duration, so that a flexible date search has cheaper dates to
+        find.
+        """
+        outbound = datetime.strptime(outbounddate, "%Y-%m-%d")
+        price = self.base_price * (0.6 + 0.8 * (self.key_seed(origin, destination) % 1000) / 1000)
+        price *= 1 + 0.2 * math.sin(2 * math.pi * outbound.timetuple().tm_yday / 91)
+        price *= 1.1 if outbound.weekday() in (4, 6) else 1.0
+        if inbounddate:
+            price *= 1 + 0.01 * (datetime.strptime(inbounddate, "%Y-%m-%d") - outbound).days
+        else:
+            price *= 0.6
+        return price
+
+    def fail(self):
+        """
+        :return Random error response, None if the request succeeds
+        """
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            status = self.random.choice((429, 500))
+        if not failed:
+            return None
+        return status, {}, {'ValidationErrors': [{'Message': 'Stub error %d' % status}]}
+
+    def delay(self):
+        with self.lock:
+            latency = self.random.uniform(0.5, 1.5) * self.latency_ms / 1000.0
+        time.sleep(latency)
+
+    def autosuggest(self, query):
+        """
+        :param query - Keyword
+        :return The place named after the keyword, e.g. LOND-sky for London
+        """
+        name = " ".join(query.split())
+        if name == "":
+            return 200, {}, {'Places': []}
+        code = "".join(c for c in name.upper() if c.isalpha())[:4].ljust(4, 'X')
+        return 200, {}, {'Places': [{'PlaceId': code + '-sky',
+                                     'PlaceName': name,
+                                     'CountryId': 'XX-sky',
+                                     'RegionId': '',
+                                     'CityId': code + '-sky',
+                                     'CountryName': 'Stub'}]}
+
+    def create_session(self, form, base_url):
+        """
+        :param form - Session parameters
+        :param base_url - URL of the server, for the poll URL
+        :return 201 with the poll URL in the location header
+        """
+        for name in ('originplace', 'destinationplace', 'outbounddate'):
+            if not form.get(name):
+                return 400, {}, {'ValidationErrors': [{'Message': 'Missing %s' % name}]}
+
+        session_key = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            for key in [k for k, s in self.sessions.items() if s['created_at'] < now - self.SESSION_TTL_SEC]:
+                del self.sessions[key]
+            self.sessions[session_key] = {'form': form, 'created_at': now, 'response': None}
+
+        return 201, {'Location': '%s/apiservices/pricing/v1.0/%s' % (base_url, session_key)}, None
+
+    def poll_session(self, session_key):
+        """
+        :param session_key - Session key
+        :return The itineraries found so far, all of them after complete_sec
+        """
+        with self.lock:
+            session = self.sessions.get(session_key)
+        if session is None:
+            return 410, {}, {'ValidationErrors': [{'Message': 'Session expired'}]}
+
+        form = session['form']
+        if session['response'] is None:
+            origin, destination = form['originplace'], form['destinationplace']
+            outbounddate, inbounddate = form['outbounddate'], form.get('inbounddate')
+            session['response'] = generate_response(
+                self.n_itinerary,
+                seed=self.key_seed(origin, destination, outbounddate, inbounddate),
+                origin=origin, destination=destination,
+                outbounddate=outbounddate, inbounddate=inbounddate,
+                base_price=self.route_price(origin, destination, outbounddate, inbounddate))
+
+        response = session['response']
+        elapsed = time.time() - session['created_at']
+        if elapsed >= self.complete_sec:
+            return 200, {}, response
+
+        response = dict(response)
+        n = max(1, int(len(response['Itineraries']) * elapsed / self.complete_sec))
+        response['Itineraries'] = response['Itineraries'][:n]
+        response['Status'] = 'UpdatesPending'
+        return 200, {}, response
+
+    def browse(self, origin, destination, outbound, inbound):
+        """
+        Cached prices of the browse endpoints, one quote per date pair of the
+        outbound and inbound dates or months
+        :param outbound - Outbound date or month
+        :param inbound - Inbound date or month, one way if None
+        :return Quotes
+        """
+        def dates(partial):
+            if len(partial) == 10:
+                return [partial]
+            elif len(partial) != 7:
+                # e.g. anytime, not used by the dashboard
+                return []
+            first = datetime.strptime(partial + "-01", "%Y-%m-%d")
+            return [(first + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(31)
+                    if (first + timedelta(days=d)).month == first.month]
+
+        quotes = []
+        for outbounddate in dates(outbound):
+            for inbounddate in dates(inbound) if inbound else [None]:
+                if inbounddate is not None and inbounddate < outbounddate:
+                    continue
+                rnd = random.Random(self.key_seed('browse', origin, destination, outbounddate, inbounddate))
+                # Only some date pairs were searched recently, at a slightly stale price
+                if rnd.random() < 0.2:
+                    continue
+                price = self.route_price(origin, destination, outbounddate, inbounddate) * \
+                    self.lowest_ratio * rnd.uniform(0.95, 1.15)
+                quote = {'QuoteId': len(quotes) + 1,
+                         'MinPrice': round(price, 2),
+                         'Direct': rnd.random() < 0.2,
+                         'OutboundLeg': {'CarrierIds': [], 'OriginId': origin, 'DestinationId': destination,
+                                         'DepartureDate': outbounddate + 'T00:00:00'},
+                         'QuoteDateTime': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")}
+                if inbounddate is not None:
+                    quote['InboundLeg'] = {'CarrierIds': [], 'OriginId': destination, 'DestinationId': origin,
+                                           'DepartureDate': inbounddate + 'T00:00:00'}
+                quotes.append(quote)
+
+        return 200, {}, {'Quotes': quotes, 'Places': [], 'Carriers': [], 'Currencies': []}
+
+    def handle(self, method, path, query, form, base_url):
+        """
+        Route a request
+        :return Tuple of the status, the headers and the json body
+        """
+        self.delay()
+        error = self.fail()
+        if error is not None:
+            return error
+
+        parts = [p for p in path.split('/') if p]
+        if parts[:3] == ['apiservices', 'autosuggest', 'v1.0']:
+            return self.autosuggest(query.get('query', ''))
+        elif parts[:3] == ['apiservices', 'pricing', 'v1.0'] and method == 'POST' and len(parts) == 3:
+            return self.create_session(form, base_url)
+        elif parts[:3] == ['apiservices', 'pricing', 'v1.0'] and method == 'GET' and len(parts) == 4:
+            return self.poll_session(parts[3])
+        elif len(parts) >= 8 and parts[0] == 'apiservices' and parts[1] in ('browsedates', 'browsequotes',
+                                                                             'browsegrid', 'browseroutes'):
+            return self.browse(parts[6], parts[7],
+                               parts[8] if len(parts) > 8 else 'anytime',
+                               parts[9] if len(parts) > 9 else None)
+
+        return 404, {}, {'ValidationErrors': [{'Message': 'Unknown endpoint %s' % path}]}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of StubApi, keeping the connections alive as the pooled
+    transport does
+    """
+    protocol_version = 'HTTP/1.1'
+    api = None
+
+    def respond(self, method):
+        url = urlsplit(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        form = {}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > 0:
+            form = dict((k, v[-1]) for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items())
+
+        base_url = "http://%s" % (self.headers.get('Host') or "%s:%d" % self.server.server_address[:2])
+        status, headers, body = self.api.handle(method, url.path, query, form, base_url)
+        content = b"" if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def log_message(self, format, *args):
+        print_log(self.__class__.__name__, "log_message", format, *args, level=logging.DEBUG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of the Skyscanner API for load testing. "
+                                                 "Point a configuration to it with API_HOST.")
+    parser.add_argument('--host', default='127.0.0.1', help="Listening address")
+    parser.add_argument('--port', type=int, default=8800, help="Listening port")
+    parser.add_argument('--itineraries', type=int, default=500,
+                        help="Number of itineraries of a complete live pricing response")
+    parser.add_argument('--latency-ms', type=float, default=50.0, help="Average latency of a request")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of the requests failing with 429 or 500")
+    parser.add_argument('--complete-sec', type=float, default=2.0,
+                        help="Time for a live pricing session to complete")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the responses")
+    args = parser.parse_args()
+
+    StubRequestHandler.api = StubApi(n_itinerary=args.itineraries,
+                                     latency_ms=args.latency_ms,
+                                     error_rate=args.error_rate,
+                                     complete_sec=args.complete_sec,
+                                     seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), StubRequestHandler)
+    server.daemon_threads = True
+    print_log("StubServer", "main", "Serving the stub API on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import random
+from datetime import datetime, timedelta
+
+CARRIERS = ['Cathay Pacific', 'British Airways', 'Emirates', 'Qatar Airways', 'KLM',
+            'Lufthansa', 'Finnair', 'SAS', 'Air France', 'Turkish Airlines',
+            'China Eastern', 'China Southern', 'Air China', 'Aeroflot', 'Swiss',
+            'Austrian Airlines', 'Iberia', 'Etihad Airways', 'Singapore Airlines', 'Thai Airways']
+
+AGENTS = ['Expedia', 'Trip.com', 'Opodo', 'eDreams', 'Kiwi.com', 'Mytrip', 'Gotogate',
+          'Travelgenio', 'Budgetair', 'Cathay Pacific', 'British Airways', 'Emirates']
+
+HUBS = ['Doha', 'Dubai', 'Helsinki', 'Frankfurt', 'Istanbul', 'Amsterdam', 'Paris', 'Zurich',
+        'Vienna', 'Moscow', 'Beijing', 'Shanghai', 'Bangkok', 'Singapore', 'Abu Dhabi']
+
+
+def generate_response(n_itinerary, seed=0, origin='Hong Kong', destination='London',
+                      outbounddate='2017-03-01', inbounddate='2017-03-08',
+                      n_pricing_options=5, base_price=4000.0):
+    """
+    Generate a live pricing response in the format of the Skyscanner API
+    :param n_itinerary - Number of itineraries
+    :param seed - Random seed
+    :param origin - Origin city name
+    :param destination - Destination city name
+    :param outbounddate - Outbound date in %Y-%m-%d
+    :param inbounddate - Inbound date in %Y-%m-%d, one way if None
+    :param n_pricing_options - Maximum number of pricing options per itinerary
+    :param base_price - Typical lowest price
+    :return The parsed response
+    """
+    rnd = random.Random(seed)
+    places = [{'Id': 1000 + n, 'ParentId': None, 'Code': name[:3].upper(), 'Type': 'Airport', 'Name': name}
+              for n, name in enumerate([origin, destination] + HUBS)]
+    carriers = [{'Id': 100 + n, 'Code': name[:2].upper(), 'Name': name, 'ImageUrl': '',
+                 'DisplayCode': name[:2].upper()}
+                for n, name in enumerate(CARRIERS)]
+    agents = [{'Id': 5000 + n, 'Name': name, 'ImageUrl': '', 'Status': 'UpdatesComplete',
+               'OptimisedForMobile': rnd.random() < 0.5, 'BookingNumber': '', 'Type': 'TravelAgent'}
+              for n, name in enumerate(AGENTS)]
+
+    def leg(n, direction, date, origin_id, destination_id):
+        departure = datetime.strptime(date, "%Y-%m-%d") + timedelta(minutes=rnd.randrange(0, 24 * 60, 5))
+        arrival = departure + timedelta(minutes=rnd.randrange(11 * 60, 30 * 60, 5))
+        n_stops = rnd.choice([0, 1, 1, 1, 2])
+        return {'Id': '%s-%d-%d' % (direction, seed, n),
+                'SegmentIds': list(range(n_stops + 1)),
+                'OriginStation': origin_id,
+                'DestinationStation': destination_id,
+                'Departure': departure.strftime("%Y-%m-%dT%H:%M:%S"),
+                'Arrival': arrival.strftime("%Y-%m-%dT%H:%M:%S"),
+                'Duration': int((arrival - departure).total_seconds() / 60),
+                'JourneyMode': 'Flight',
+                'Stops': [rnd.choice(places[2:])['Id'] for _ in range(n_stops)],
+                'Carriers': [rnd.choice(carriers)['Id'] for _ in range(max(1, n_stops))],
+                'OperatingCarriers': [],
+                'Directionality': direction,
+                'FlightNumbers': []}
+
+    legs = []
+    itineraries = []
+    for n in range(n_itinerary):
+        outbound = leg(n, 'Outbound', outbounddate, places[0]['Id'], places[1]['Id'])
+        legs.append(outbound)
+        itinerary = {'OutboundLegId': outbound['Id'],
+                     'PricingOptions': [],
+                     'BookingDetailsLink': {'Uri': '', 'Body': '', 'Method': 'PUT'}}
+        if inbounddate is not None:
+            inbound = leg(n, 'Inbound', inbounddate, places[1]['Id'], places[0]['Id'])
+            legs.append(inbound)
+            itinerary['InboundLegId'] = inbound['Id']
+
+        price = base_price * rnd.lognormvariate(0.3, 0.35)
+        for _ in range(rnd.randint(1, n_pricing_options)):
+            itinerary['PricingOptions'].append({'Agents': [rnd.choice(agents)['Id']],
+                                                'QuoteAgeInMinutes': rnd.randrange(0, 120),
+                                                'Price': round(price * rnd.uniform(1.0, 1.15), 2),
+                                                'DeeplinkUrl': ''})
+        itineraries.append(itinerary)
+
+    return {'SessionKey': 'synthetic-%d' % seed,
+            'Query': {'Country': 'HK', 'Currency': 'HKD', 'Locale': 'en-GB', 'Adults': 1,
+                      'Children': 0, 'Infants': 0,
+                      'OriginPlace': str(places[0]['Id']), 'DestinationPlace': str(places[1]['Id']),
+                      'OutboundDate': outbounddate, 'InboundDate': inbounddate or '',
+                      'LocationSchema': 'Default', 'CabinClass': 'Economy', 'GroupPricing': False},
+            'Status': 'UpdatesComplete',
+            'Itineraries': itineraries,
+            'Legs': legs,
+            'Segments': [],
+            'Carriers': carriers,
+            'Agents': agents,
+            'Places': places,
+            'Currencies': [{'Code': 'HKD', 'Symbol': 'HK$', 'DecimalDigits': 2}]}
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from skyscanner.skyscanner import Transport, GRACEFUL, STRICT, IGNORE, log
+from metrics import metrics
+
+
+class PooledTransport:
+    """
+    HTTP transport on a keep-alive session with a connection pool. Requests
+    failing with 429, 5xx or a connection error are retried with jittered
+    exponential backoff.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout_sec=30, max_retries=3, backoff_sec=0.5, pool_size=10):
+        """
+        :param timeout_sec - Timeout of each request in seconds
+        :param max_retries - Maximum number of retries of a request
+        :param backoff_sec - Base backoff time in seconds
+        :param pool_size - Number of connections kept alive per host
+        """
+        self.timeout_sec = timeout_sec
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, headers=None, data=None, params=None, deadline=None, budget=None):
+        """
+        :param deadline - time.monotonic() by which the request and its
+                          retries must end, unbounded if None
+        :param budget - RequestBudget charged for every attempt, None if
+                        unlimited
+        :return requests.Response
+        """
+        attempt = 0
+        while True:
+            if deadline is not None and deadline <= time.monotonic():
+                raise requests.Timeout("Deadline of %s %s exceeded" % (method.upper(), url))
+            # No token is spent on a request which cannot be sent in time
+            if budget is not None and not budget.acquire(deadline):
+                raise requests.Timeout("No request budget left before the deadline of %s %s" %
+                                       (method.upper(), url))
+            timeout_sec = self.timeout_sec
+            if deadline is not None:
+                timeout_sec = min(timeout_sec, deadline - time.monotonic())
+                if timeout_sec <= 0:
+                    raise requests.Timeout("Deadline of %s %s exceeded" % (method.upper(), url))
+
+            resp = None
+            try:
+                resp = self.session.request(method, url, headers=headers, data=data,
+                                            params=params, timeout=timeout_sec)
+                if resp.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return resp
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+
+            backoff_sec = random.uniform(0, self.backoff_sec * (2 ** attempt))
+            if deadline is not None and time.monotonic() + backoff_sec >= deadline:
+                # No time left for a retry
+                if resp is None:
+                    raise requests.Timeout("Deadline of %s %s exceeded" % (method.upper(), url))
+                return resp
+
+            time.sleep(backoff_sec)
+            attempt += 1
+
+
+class RecordTransport:
+    """
+    Transport saving every response to a directory for ReplayTransport
+    """
+    def __init__(self, transport, record_dir):
+        """
+        :param transport - Transport performing the requests
+        :param record_dir - Directory of the recorded responses
+        """
+        self.transport = transport
+        self.record_dir = record_dir
+        os.makedirs(record_dir, exist_ok=True)
+
+    @staticmethod
+    def record_path(record_dir, method, url, data, params):
+        """
+        :return File path of the recorded response. The API key is not part
+                of the request key.
+        """
+        params = dict((k, v) for k, v in (params or {}).items() if k.lower() != 'apikey')
+        key = json.dumps([method.lower(), url, sorted((data or {}).items()), sorted(params.items())],
+                         default=str)
+        return os.path.join(record_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def request(self, method, url, headers=None, data=None, params=None, deadline=None, budget=None):
+        """
+        :return requests.Response
+        """
+        resp = self.transport.request(method, url, headers=headers, data=data, params=params,
+                                      deadline=deadline, budget=budget)
+        # A poll URL returns a more complete result on each call, so the
+        # last response of a request overwrites the earlier ones
+        with open(self.record_path(self.record_dir, method, url, data, params), 'w') as f:
+            json.dump({'method': method,
+                       'url': url,
+                       'status_code': resp.status_code,
+                       'headers': dict(resp.headers),
+                       'content': resp.content.decode('utf-8')}, f)
+        return resp
+
+
+class ReplayTransport:
+    """
+    Transport serving the responses recorded by RecordTransport, without
+    any network access
+    """
+    def __init__(self, record_dir):
+        """
+        :param record_dir - Directory of the recorded responses
+        """
+        self.record_dir = record_dir
+
+    def request(self, method, url, headers=None, data=None, params=None, deadline=None, budget=None):
+        """
+        :return requests.Response
+        """
+        path = RecordTransport.record_path(self.record_dir, method, url, data, params)
+        if not os.path.exists(path):
+            raise LookupError("No recorded response of %s %s %s" % (method.upper(), url, data or params))
+
+        with open(path) as f:
+            record = json.load(f)
+
+        resp = requests.Response()
+        resp.status_code = record['status_code']
+        resp.headers = CaseInsensitiveDict(record['headers'])
+        resp.headers.pop('Content-Encoding', None)
+        resp._content = record['content'].encode('utf-8')
+        resp.encoding = 'utf-8'
+        resp.url = url
+        return resp
+
+
+def create_transport(conf):
+    """
+    Create the transport from the configuration
+    :param conf - Configuration object
+    :return Transport object
+    """
+    transport_type = conf.get_http_transport()
+    if transport_type == 'replay':
+        return ReplayTransport(conf.get_http_record_dir())
+
+    transport = PooledTransport(timeout_sec=conf.get_http_timeout_sec(),
+                                max_retries=conf.get_http_max_retries(),
+                                pool_size=conf.get_max_concurrent_queries())
+    if transport_type == 'record':
+        return RecordTransport(transport, conf.get_http_record_dir())
+    elif transport_type != 'pooled':
+        raise ValueError("Unknown HTTP_TRANSPORT %s" % transport_type)
+
+    return transport
+
+
+class TransportMixin:
+    """
+    Mixin of the skyscanner clients performing the requests through an
+    injectable transport instead of the requests module functions.
+    """
+    transport = None
+    # Replaces the API host of the request URLs, e.g. to use stub_server.py
+    api_host = None
+    # RequestBudget charged for every attempt of a request, e.g. by the monitor
+    request_budget = None
+
+    def get_deadline(self):
+        """
+        :return time.monotonic() by which the current request must end, None
+                if unbounded
+        """
+        return None
+
+    def make_request(self, service_url, method='get', headers=None, data=None,
+                     callback=None, errors=GRACEFUL, **params):
+        """
+        Same as skyscanner.Transport.make_request, see its documentation.
+        The in-flight calls, the requests and the errors are counted in
+        the metrics.
+        """
+        metrics.incr('api_requests')
+        metrics.gauge_add('api_inflight', 1)
+        try:
+            return self._make_request(service_url, method, headers, data, callback, errors, params)
+        except Exception:
+            metrics.incr('api_errors')
+            raise
+        finally:
+            metrics.gauge_add('api_inflight', -1)
+
+    def _make_request(self, service_url, method, headers, data, callback, errors, params):
+        if self.api_host and service_url.startswith(Transport.API_HOST):
+            service_url = self.api_host + service_url[len(Transport.API_HOST):]
+
+        if self.transport is None:
+            if self.request_budget is not None:
+                self.request_budget.acquire()
+            return super().make_request(service_url, method=method, headers=headers, data=data,
+                                        callback=callback, errors=errors, **params)
+
+        error_mode = errors or GRACEFUL
+        if error_mode.lower() not in (STRICT, GRACEFUL, IGNORE):
+            raise ValueError('Possible values for errors argument are: %s' %
+                             ', '.join((STRICT, GRACEFUL, IGNORE)))
+
+        if callback is None:
+            callback = self._default_resp_callback
+
+        if 'apikey' not in service_url.lower():
+            params.update({'apiKey': self.api_key})
+
+        log.debug('* Request URL: %s' % service_url)
+        r = self.transport.request(method, service_url, headers=headers, data=data, params=params,
+                                   deadline=self.get_deadline(), budget=self.request_budget)
+        try:
+            r.raise_for_status()
+            return callback(r)
+        except Exception as e:
+            if r.status_code >= 400:
+                metrics.incr('api_http_errors')
+            return self._with_error_handling(r, e, error_mode, self.response_format)
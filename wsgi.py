@@ -0,0 +1,12 @@
+"""
+WSGI entry point, e.g.
+
+    SKYSCANNER_CONFIG=default.ini gunicorn --workers 4 --threads 8 wsgi:application
+
+Each worker process creates its own app. The workers share the query
+cache, the place index and the search jobs through SQLITE_FILE_PATH.
+"""
+import os
+from run import create_app
+
+application = create_app(os.getenv('SKYSCANNER_CONFIG', 'default.ini'))